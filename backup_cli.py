@@ -0,0 +1,262 @@
+"""Command-line client for pushing and pulling directory trees to a node.
+
+    python backup_cli.py push ~/Documents --prefix laptop/Documents
+    python backup_cli.py pull ./restore --prefix laptop/Documents
+    python backup_cli.py list --prefix laptop/
+
+Transfers run on a pool of parallel workers. Files whose hash already
+matches on the other side are skipped, so re-running an interrupted
+transfer resumes it. Every file produces one JSON line on stdout, followed
+by a summary line; the exit status is 1 if any file failed.
+"""
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from storage_layout import normalize_path
+
+DEFAULT_NODE = 'localhost:8000'
+DEFAULT_JOBS = 8
+RETRIES = 3
+CHUNK_SIZE = 1024 * 1024
+HASH_CACHE = os.path.expanduser('~/.backup_cli_hashes.json')
+
+output_lock = threading.Lock()
+
+def emit(event, **fields):
+    """Write one JSON line to stdout"""
+    with output_lock:
+        sys.stdout.write(json.dumps({'event': event, **fields}) + '\n')
+        sys.stdout.flush()
+
+class HashCache:
+    """Local file hashes keyed by path, valid while size and mtime are unchanged"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def hash(self, filepath):
+        st = os.stat(filepath)
+        key = os.path.abspath(filepath)
+        cached = self.entries.get(key)
+        if cached and cached['size'] == st.st_size and cached['mtime_ns'] == st.st_mtime_ns:
+            return cached['hash']
+
+        hash_md5 = hashlib.md5()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                hash_md5.update(chunk)
+        with self.lock:
+            self.entries[key] = {'hash': hash_md5.hexdigest(), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+        return hash_md5.hexdigest()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with self.lock:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+def remote_files(node, prefix):
+    """Map of name -> listing record for the node's files under prefix"""
+    resp = requests.get(f"http://{node}/files", params={'format': 'ndjson'}, stream=True, timeout=30)
+    resp.raise_for_status()
+    if resp.headers.get('Content-Type', '').startswith('application/x-ndjson'):
+        records = (json.loads(line) for line in resp.iter_lines() if line)
+    else:
+        records = resp.json()
+    return {f['name']: f for f in records
+            if not f.get('deleted') and (not prefix or f['name'].startswith(prefix + '/'))}
+
+def remote_name(prefix, relative):
+    return normalize_path(f"{prefix}/{relative}" if prefix else relative)
+
+def with_retries(action):
+    """Run action(), retrying transient failures with backoff.
+
+    A node that answers 503 is retried after its Retry-After, jittered so
+    that parallel workers do not all come back at once.
+    """
+    for attempt in range(RETRIES):
+        try:
+            return action()
+        except (requests.RequestException, IOError) as e:
+            if attempt == RETRIES - 1:
+                raise
+            delay = 2 ** attempt
+            response = getattr(e, 'response', None)
+            if response is not None and response.status_code == 503:
+                try:
+                    delay = float(response.headers['Retry-After']) * random.uniform(0.5, 1.5)
+                except (KeyError, ValueError):
+                    pass
+            time.sleep(delay)
+
+def push_file(node, filepath, name, remote, hashes):
+    """Upload one file unless the node already has identical content"""
+    started = time.time()
+    size = os.path.getsize(filepath)
+    record = remote.get(name)
+    # Only files whose size matches can be identical; skip hashing the rest
+    file_hash = hashes.hash(filepath) if record and record.get('size') == size else None
+    if file_hash and record.get('hash') == file_hash:
+        return 'skipped', {'name': name, 'size': size, 'hash': file_hash}
+
+    def upload():
+        with open(filepath, 'rb') as f:
+            resp = requests.post(f"http://{node}/upload", data=f,
+                                 headers={'Filename': quote(name)}, timeout=300)
+        resp.raise_for_status()
+        return resp.json()
+
+    result = with_retries(upload)
+    if file_hash and result['hash'] != file_hash:
+        raise IOError(f"Node stored hash {result['hash']}, expected {file_hash}")
+    return 'pushed', {'name': name, 'size': result['size'], 'hash': result['hash'],
+                      'seconds': round(time.time() - started, 3)}
+
+def pull_file(node, name, record, filepath, hashes):
+    """Download one file unless the local copy is already identical"""
+    started = time.time()
+    if (os.path.isfile(filepath) and os.path.getsize(filepath) == record.get('size')
+            and hashes.hash(filepath) == record.get('hash')):
+        return 'skipped', {'name': name, 'size': record['size'], 'hash': record['hash']}
+
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+    part_path = filepath + '.part'
+
+    def download():
+        hash_md5 = hashlib.md5()
+        size = 0
+        with requests.get(f"http://{node}/download", params={'filename': name},
+                          stream=True, timeout=300) as resp:
+            resp.raise_for_status()
+            with open(part_path, 'wb') as f:
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+                    hash_md5.update(chunk)
+                    size += len(chunk)
+        if record.get('hash') and hash_md5.hexdigest() != record['hash']:
+            raise IOError(f"Downloaded hash {hash_md5.hexdigest()}, expected {record['hash']}")
+        return hash_md5.hexdigest(), size
+
+    file_hash, size = with_retries(download)
+    os.replace(part_path, filepath)
+    return 'pulled', {'name': name, 'size': size, 'hash': file_hash,
+                      'seconds': round(time.time() - started, 3)}
+
+def run_jobs(jobs, workers):
+    """Run (function, args, name) jobs in parallel, reporting each and a summary"""
+    started = time.time()
+    totals = {'pushed': 0, 'pulled': 0, 'skipped': 0, 'errors': 0, 'bytes': 0}
+
+    def run(job):
+        function, args, name = job
+        try:
+            event, fields = function(*args)
+        except Exception as e:
+            event, fields = 'error', {'name': name, 'error': str(e)}
+        with output_lock:
+            totals['errors' if event == 'error' else event] += 1
+            if event in ('pushed', 'pulled'):
+                totals['bytes'] += fields['size']
+        emit(event, **fields)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Bounded submission keeps memory flat for very large trees
+        pending = []
+        for job in jobs:
+            pending.append(pool.submit(run, job))
+            if len(pending) >= workers * 4:
+                pending.pop(0).result()
+        for future in pending:
+            future.result()
+
+    seconds = time.time() - started
+    emit('summary', **totals, seconds=round(seconds, 3),
+         mb_per_sec=round(totals['bytes'] / 1024**2 / max(seconds, 0.001), 2))
+    return 1 if totals['errors'] else 0
+
+def push(args, hashes):
+    prefix = normalize_path(args.prefix) or ''
+    remote = remote_files(args.node, prefix)
+    source = os.path.abspath(args.directory)
+
+    def jobs():
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for filename in sorted(files):
+                filepath = os.path.join(root, filename)
+                if filename.endswith('.part') or not os.path.isfile(filepath):
+                    continue
+                name = remote_name(prefix, os.path.relpath(filepath, source))
+                yield push_file, (args.node, filepath, name, remote, hashes), name
+
+    return run_jobs(jobs(), args.jobs)
+
+def pull(args, hashes):
+    prefix = normalize_path(args.prefix) or ''
+    remote = remote_files(args.node, prefix)
+    target = os.path.abspath(args.directory)
+
+    def jobs():
+        for name in sorted(remote):
+            relative = normalize_path(name[len(prefix) + 1:] if prefix else name)
+            if not relative:
+                continue
+            filepath = os.path.join(target, *relative.split('/'))
+            yield pull_file, (args.node, name, remote[name], filepath, hashes), name
+
+    return run_jobs(jobs(), args.jobs)
+
+def list_files(args, hashes):
+    for name, record in sorted(remote_files(args.node, normalize_path(args.prefix) or '').items()):
+        emit('file', **record)
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk push and pull of directory trees to a backup node")
+    parser.add_argument('--node', default=DEFAULT_NODE, help=f"node address (default {DEFAULT_NODE})")
+    parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS,
+                        help=f"parallel transfers (default {DEFAULT_JOBS})")
+    parser.add_argument('--hash-cache', default=HASH_CACHE, help="file caching local hashes between runs")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    push_parser = commands.add_parser('push', help="upload a directory tree")
+    push_parser.add_argument('directory')
+    push_parser.add_argument('--prefix', default='', help="remote path to store the tree under")
+    push_parser.set_defaults(run=push)
+
+    pull_parser = commands.add_parser('pull', help="download files into a directory")
+    pull_parser.add_argument('directory')
+    pull_parser.add_argument('--prefix', default='', help="remote path to download")
+    pull_parser.set_defaults(run=pull)
+
+    list_parser = commands.add_parser('list', help="list files on the node")
+    list_parser.add_argument('--prefix', default='')
+    list_parser.set_defaults(run=list_files)
+
+    args = parser.parse_args()
+    hashes = HashCache(args.hash_cache)
+    try:
+        return args.run(args, hashes)
+    except requests.RequestException as e:
+        emit('error', error=str(e))
+        return 1
+    finally:
+        hashes.save()
+
+if __name__ == '__main__':
+    sys.exit(main())
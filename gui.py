@@ -1,14 +1,18 @@
 import os
 import json
+import queue
 import tkinter as tk
-from tkinter import filedialog, messagebox, scrolledtext, simpledialog
+from tkinter import ttk, filedialog, messagebox, scrolledtext, simpledialog
 import requests
 import threading
 
 STORAGE_DIR = 'storage'
+IMPORT_DIR = '.imports'    # files being copied into storage
 CONFIG_FILE = 'config.json'
+COPY_CHUNK_SIZE = 1024 * 1024
 
 os.makedirs(STORAGE_DIR, exist_ok=True)
+os.makedirs(IMPORT_DIR, exist_ok=True)
 
 with open(CONFIG_FILE) as f:
     NODES = json.load(f)['nodes']
@@ -52,16 +56,61 @@ class BackupGUI:
         if not path:
             return
 
+        # Copy on a worker thread so the window stays responsive
+        win = tk.Toplevel(self.master)
+        win.title("Adding File")
+        tk.Label(win, text=os.path.basename(path)).pack(padx=10, pady=5)
+        bar = ttk.Progressbar(win, length=300, maximum=max(os.path.getsize(path), 1))
+        bar.pack(padx=10, pady=5)
+        cancel_event = threading.Event()
+        tk.Button(win, text="Cancel", command=cancel_event.set).pack(pady=5)
+        win.protocol("WM_DELETE_WINDOW", cancel_event.set)
+
+        events = queue.Queue()
+        threading.Thread(target=self.copy_file, args=(path, events, cancel_event), daemon=True).start()
+        self.master.after(100, self.poll_upload, win, bar, events)
+
+    def copy_file(self, path, events, cancel_event):
         filename = os.path.basename(path)
+        tmp_path = os.path.join(IMPORT_DIR, f"{threading.get_ident()}-{filename}")
         try:
-            with open(path, 'rb') as f:
-                data = f.read()
-            with open(os.path.join(STORAGE_DIR, filename), 'wb') as out:
-                out.write(data)
-            self.log(f"Added '{filename}' to local storage.")
-            self.view_files()
-        except Exception as e:
-            messagebox.showerror("Error", f"Upload failed: {e}")
+            copied = 0
+            with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                while True:
+                    if cancel_event.is_set():
+                        raise InterruptedError()
+                    chunk = src.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    copied += len(chunk)
+                    events.put(('progress', copied))
+            os.replace(tmp_path, os.path.join(STORAGE_DIR, filename))
+            events.put(('done', filename))
+        except BaseException as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            events.put(('cancelled', filename) if isinstance(e, InterruptedError) else ('error', e))
+
+    def poll_upload(self, win, bar, events):
+        while True:
+            try:
+                kind, value = events.get_nowait()
+            except queue.Empty:
+                self.master.after(100, self.poll_upload, win, bar, events)
+                return
+            if kind == 'progress':
+                bar['value'] = value
+                continue
+            win.destroy()
+            if kind == 'done':
+                self.log(f"Added '{value}' to local storage.")
+                self.view_files()
+            elif kind == 'cancelled':
+                self.log(f"Cancelled adding '{value}'.")
+            else:
+                messagebox.showerror("Error", f"Upload failed: {value}")
+            return
 
     def delete_file(self):
         selected = self.file_listbox.curselection()
@@ -4,13 +4,23 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
 import requests
 import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import quote
 import hashlib
+from storage_layout import prepare_location
+from storage_engine import StorageEngine, remote_listing
 
 STORAGE_DIR = 'storage'
 CONFIG_FILE = 'config.json'
+REFRESH_BATCH_SIZE = 500   # rows applied to the file tree per UI tick
+IMPORT_DIR = '.imports'    # files being copied into storage
+IMPORT_WORKERS = 4
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
 
 os.makedirs(STORAGE_DIR, exist_ok=True)
+os.makedirs(IMPORT_DIR, exist_ok=True)
 
 # Load configuration
 def load_config():
@@ -22,6 +32,60 @@ def load_config():
     with open(CONFIG_FILE) as f:
         return json.load(f)
 
+# The index shared with the node and web_gui; imported files are recorded
+# with their hash so the node does not rehash them
+storage = StorageEngine(STORAGE_DIR, load_config().get('tiering', {}).get('cold_dir', 'cold'))
+
+class ImportCancelled(Exception):
+    """Raised when an import is cancelled mid-copy"""
+
+def copy_in_kernel(src_fd, dst_fd, offset, count):
+    """Copy a byte range with copy_file_range; False if the platform can't"""
+    # On btrfs/XFS this shares extents (reflink) instead of writing data
+    try:
+        copied = 0
+        while copied < count:
+            n = os.copy_file_range(src_fd, dst_fd, count - copied,
+                                   offset + copied, offset + copied)
+            if n == 0:
+                return False
+            copied += n
+        return True
+    except OSError:
+        return False
+
+def import_file(src_path, dst_path, on_progress, cancel_event):
+    """Copy a file into storage, hashing it on the way"""
+    hash_md5 = hashlib.md5()
+    tmp_path = os.path.join(IMPORT_DIR, f"{threading.get_ident()}-{os.path.basename(dst_path)}")
+    kernel_copy = hasattr(os, 'copy_file_range')
+    size = 0
+    
+    try:
+        with open(src_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            while True:
+                if cancel_event.is_set():
+                    raise ImportCancelled()
+                # The chunk has to be read for hashing; the kernel still does the copy
+                chunk = src.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                hash_md5.update(chunk)
+                if kernel_copy:
+                    kernel_copy = copy_in_kernel(src.fileno(), dst.fileno(), size, len(chunk))
+                if not kernel_copy:
+                    dst.seek(size)
+                    dst.write(chunk)
+                size += len(chunk)
+                on_progress(size)
+        os.replace(tmp_path, dst_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    
+    return hash_md5.hexdigest(), size
+
 config = load_config()
 NODES = config.get('nodes', [])
 
@@ -75,6 +139,10 @@ class ModernBackupGUI:
         style.map('Accent.TButton',
                  background=[('active', self.accent_hover)])
         
+        # File tree state: rows currently shown and the latest scan
+        self.row_values = {}
+        self.refresh_generation = 0
+        
         # Create main layout
         self.create_widgets()
         
@@ -276,56 +344,171 @@ class ModernBackupGUI:
         return f"{size:.1f} TB"
     
     def refresh_files(self):
-        """Refresh file list"""
-        self.file_tree.delete(*self.file_tree.get_children())
+        """Rescan storage in the background and update the file list"""
+        self.refresh_generation += 1
+        generation = self.refresh_generation
+        results = queue.Queue()
+        threading.Thread(target=self.scan_storage, args=(results,), daemon=True).start()
+        self.master.after(50, self.apply_scan_results, generation, results, set())
+    
+    def scan_storage(self, results):
+        """List storage off the UI thread, sending rows in batches"""
+        try:
+            batch = []
+            for f in storage.files():
+                modified = datetime.fromisoformat(f['modified']).strftime('%Y-%m-%d %H:%M') if f['modified'] else ''
+                batch.append((f['name'], (
+                    f['name'],
+                    self.format_size(f['size']) + (' ❄' if f['tier'] == 'cold' else ''),
+                    modified,
+                    f['hash'][:8] + '...' if f['hash'] else '—'
+                )))
+                if len(batch) >= REFRESH_BATCH_SIZE:
+                    results.put(batch)
+                    batch = []
+            results.put(batch)
+            results.put(None)
+        except Exception as e:
+            results.put(e)
+    
+    def apply_scan_results(self, generation, results, seen):
+        """Apply scanned rows to the tree a batch at a time"""
+        if generation != self.refresh_generation:
+            return  # a newer refresh replaced this one
         
         try:
-            files = os.listdir(STORAGE_DIR)
-            file_count = 0
-            
-            for filename in files:
-                filepath = os.path.join(STORAGE_DIR, filename)
-                if os.path.isfile(filepath):
-                    size = os.path.getsize(filepath)
-                    mtime = datetime.fromtimestamp(os.path.getmtime(filepath))
-                    
-                    # Calculate hash for first 1KB (for speed)
-                    with open(filepath, 'rb') as f:
-                        file_hash = hashlib.md5(f.read(1024)).hexdigest()[:8]
-                    
-                    self.file_tree.insert('', 'end', values=(
-                        filename,
-                        self.format_size(size),
-                        mtime.strftime('%Y-%m-%d %H:%M'),
-                        file_hash + '...'
-                    ))
-                    file_count += 1
+            batch = results.get_nowait()
+        except queue.Empty:
+            self.master.after(50, self.apply_scan_results, generation, results, seen)
+            return
+        
+        if isinstance(batch, Exception):
+            self.log(f"Error refreshing files: {batch}", "error")
+            return
+        
+        if batch is None:
+            # Scan finished: drop rows for files that no longer exist
+            for iid in set(self.row_values) - seen:
+                self.file_tree.delete(iid)
+                del self.row_values[iid]
             
+            file_count = len(self.row_values)
             self.file_count_label.config(text=f"{file_count} file{'s' if file_count != 1 else ''}")
-            
             if file_count == 0:
                 self.log("Storage folder is empty", "warning")
-        except Exception as e:
-            self.log(f"Error refreshing files: {e}", "error")
+            return
+        
+        for iid, values in batch:
+            seen.add(iid)
+            if iid not in self.row_values:
+                self.file_tree.insert('', 'end', iid=iid, values=values)
+            elif self.row_values[iid] != values:
+                self.file_tree.item(iid, values=values)
+            self.row_values[iid] = values
+        
+        self.master.after_idle(self.apply_scan_results, generation, results, seen)
     
     def upload_file(self):
-        """Upload file(s) to storage"""
+        """Import file(s) into storage on a background worker pool"""
         paths = filedialog.askopenfilenames(title="Select files to add")
         if not paths:
             return
         
+        win = tk.Toplevel(self.master)
+        win.title("➕ Adding Files")
+        win.geometry("500x300")
+        win.configure(bg=self.bg_dark)
+        
+        # Scrollable list of per-file progress bars
+        canvas = tk.Canvas(win, bg=self.bg_dark, highlightthickness=0)
+        vsb = ttk.Scrollbar(win, orient="vertical", command=canvas.yview)
+        rows_frame = ttk.Frame(canvas, style='TFrame')
+        rows_frame.bind('<Configure>', lambda e: canvas.configure(scrollregion=canvas.bbox('all')))
+        canvas.create_window((0, 0), window=rows_frame, anchor='nw')
+        canvas.configure(yscrollcommand=vsb.set)
+        
+        cancel_event = threading.Event()
+        cancel_btn = tk.Button(win,
+                               text="✖ Cancel",
+                               command=cancel_event.set,
+                               bg=self.error,
+                               fg=self.text_color,
+                               font=('Segoe UI', 9, 'bold'),
+                               relief='flat',
+                               padx=15,
+                               pady=5,
+                               cursor='hand2')
+        cancel_btn.pack(side='bottom', pady=10)
+        win.protocol("WM_DELETE_WINDOW", cancel_event.set)
+        vsb.pack(side='right', fill='y')
+        canvas.pack(side='left', fill='both', expand=True, padx=10, pady=10)
+        
+        bars = {}
+        for path in paths:
+            tk.Label(rows_frame,
+                     text=os.path.basename(path),
+                     bg=self.bg_dark,
+                     fg=self.text_color,
+                     font=('Segoe UI', 9),
+                     anchor='w').pack(fill='x')
+            bar = ttk.Progressbar(rows_frame, length=440, maximum=max(os.path.getsize(path), 1))
+            bar.pack(fill='x', pady=(0, 8))
+            bars[path] = bar
+        
+        events = queue.Queue()
+        executor = ThreadPoolExecutor(max_workers=IMPORT_WORKERS)
         for path in paths:
+            executor.submit(self.import_worker, path, events, cancel_event)
+        executor.shutdown(wait=False)
+        
+        self.master.after(100, self.poll_imports, win, cancel_btn, bars, events, len(paths))
+    
+    def import_worker(self, path, events, cancel_event):
+        """Copy one file into storage and register it (runs on the worker pool)"""
+        filename = os.path.basename(path)
+        try:
+            location, dest_path = prepare_location(STORAGE_DIR, filename)
+            file_hash, size = import_file(
+                path,
+                dest_path,
+                lambda done: events.put(('progress', path, done)),
+                cancel_event
+            )
+            storage.register(filename, location, file_hash, size)
+            events.put(('done', path, file_hash))
+        except ImportCancelled:
+            events.put(('cancelled', path, None))
+        except Exception as e:
+            events.put(('error', path, e))
+    
+    def poll_imports(self, win, cancel_btn, bars, events, remaining):
+        """Apply worker progress to the import window"""
+        while True:
             try:
-                filename = os.path.basename(path)
-                dest_path = os.path.join(STORAGE_DIR, filename)
-                
-                with open(path, 'rb') as src, open(dest_path, 'wb') as dst:
-                    dst.write(src.read())
-                
+                kind, path, value = events.get_nowait()
+            except queue.Empty:
+                break
+            
+            filename = os.path.basename(path)
+            if kind == 'progress':
+                bars[path]['value'] = value
+                continue
+            
+            remaining -= 1
+            if kind == 'done':
+                bars[path]['value'] = bars[path]['maximum']
                 self.log(f"✓ Added '{filename}' to storage", "success")
-            except Exception as e:
-                self.log(f"✗ Failed to add '{filename}': {e}", "error")
+            elif kind == 'cancelled':
+                self.log(f"⚠ Cancelled adding '{filename}'", "warning")
+            else:
+                self.log(f"✗ Failed to add '{filename}': {value}", "error")
+        
+        if remaining > 0:
+            self.master.after(100, self.poll_imports, win, cancel_btn, bars, events, remaining)
+            return
         
+        cancel_btn.config(text="Close", command=win.destroy, bg=self.bg_light)
+        win.protocol("WM_DELETE_WINDOW", win.destroy)
         self.refresh_files()
     
     def delete_file(self):
@@ -335,8 +518,7 @@ class ModernBackupGUI:
             messagebox.showinfo("No Selection", "Please select a file to delete")
             return
         
-        item = self.file_tree.item(selection[0])
-        filename = item['values'][0]
+        filename = selection[0]  # rows are keyed by relative path
         
         confirm = messagebox.askyesno("Confirm Delete",
                                      f"Delete '{filename}'?\n\nThis will remove it from local storage.")
@@ -344,8 +526,8 @@ class ModernBackupGUI:
             return
         
         try:
-            filepath = os.path.join(STORAGE_DIR, filename)
-            os.remove(filepath)
+            if not storage.delete(filename):
+                raise FileNotFoundError("not in storage")
             self.log(f"✓ Deleted '{filename}'", "success")
             self.refresh_files()
         except Exception as e:
@@ -363,31 +545,30 @@ class ModernBackupGUI:
             return
         
         try:
-            local_files = set(os.listdir(STORAGE_DIR))
             synced_nodes = 0
             
             for node in NODES:
                 try:
                     # Get their file list
-                    r = requests.get(f"http://{node}/files", timeout=5)
-                    if r.status_code != 200:
+                    try:
+                        remote_files = remote_listing(node)
+                    except requests.HTTPError:
                         self.log(f"⚠ Could not reach {node}", "warning")
                         continue
                     
-                    remote_files_data = r.json()
-                    remote_files = {f['name'] if isinstance(f, dict) else f 
-                                  for f in remote_files_data}
-                    
-                    # Send missing files
-                    missing = local_files - remote_files
-                    for filename in missing:
-                        filepath = os.path.join(STORAGE_DIR, filename)
+                    # Send missing files; ones the peer deleted only if ours is newer
+                    missing = storage.missing_on(remote_files)
+                    for local in missing:
+                        filename = local['name']
                         try:
-                            with open(filepath, 'rb') as f:
-                                headers = {'Filename': filename}
+                            f = storage.open(filename)
+                            if f is None:
+                                continue  # deleted meanwhile
+                            with f:
+                                headers = {'Filename': quote(filename), 'X-Clock': str(local['clock'])}
                                 resp = requests.post(
                                     f"http://{node}/upload",
-                                    data=f.read(),
+                                    data=f,
                                     headers=headers,
                                     timeout=30
                                 )
@@ -0,0 +1,45 @@
+"""Hybrid logical clocks for ordering file versions across nodes.
+
+A timestamp packs wall-clock milliseconds into the high bits and a logical
+counter into the low COUNTER_BITS of one integer, so timestamps compare as
+plain integers. A node's clock never runs backwards and always moves past
+every timestamp it has received from a peer, so a write made after seeing
+another node's version is ordered after it even when the two nodes' wall
+clocks disagree.
+
+Versions are ordered by (timestamp, content hash): two nodes comparing the
+same pair of versions always pick the same winner.
+"""
+import time
+from threading import Lock
+
+COUNTER_BITS = 16
+
+class HybridClock:
+    def __init__(self):
+        self.last = 0
+        self.lock = Lock()
+
+    def now(self):
+        """Timestamp for a local write, later than any seen so far"""
+        with self.lock:
+            wall = int(time.time() * 1000) << COUNTER_BITS
+            self.last = max(wall, self.last + 1)
+            return self.last
+
+    def update(self, timestamp):
+        """Move past a timestamp received from another node"""
+        with self.lock:
+            self.last = max(self.last, timestamp)
+
+def wall_clock(seconds):
+    """Timestamp of a write made at a past wall-clock time, such as a file's mtime.
+
+    Times in the future are clamped to now, so a skewed mtime cannot win
+    over every later write.
+    """
+    return int(min(seconds, time.time()) * 1000) << COUNTER_BITS
+
+def newer(clock, file_hash, other_clock, other_hash):
+    """True if the first version wins over the second"""
+    return (clock, file_hash) > (other_clock, other_hash)
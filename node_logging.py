@@ -0,0 +1,146 @@
+"""Non-blocking, structured logging for the node.
+
+Threads that log only put the record on a bounded queue; a background
+listener thread formats it and writes it to the log file and the console.
+When the queue is full the record is dropped and counted rather than
+making a request wait for the disk.
+
+The file gets one JSON object per line. Each record carries the request ID
+and peer of the request or sync it was logged from, set with log_context().
+Per-request access logs can be sampled, and the file is rotated by size or
+by time.
+"""
+import sys
+import json
+import queue
+import random
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+ACCESS_LOGGER = 'node.access'  # per-request logs, subject to sampling
+QUEUE_SIZE = 10000
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_context = threading.local()
+
+@contextmanager
+def log_context(**fields):
+    """Attach fields such as request_id or peer to records logged in this block.
+
+    Yields the active fields; updating them changes later records too.
+    """
+    previous = getattr(_context, 'fields', {})
+    _context.fields = {**previous, **fields}
+    try:
+        yield _context.fields
+    finally:
+        _context.fields = previous
+
+class ContextFilter(logging.Filter):
+    """Copies the logging thread's context onto each record before it is queued"""
+    def filter(self, record):
+        for key, value in getattr(_context, 'fields', {}).items():
+            setattr(record, key, value)
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of access log records, but every warning and failed request"""
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.dropped = 0
+
+    def filter(self, record):
+        status = getattr(record, 'status', None)
+        if (record.name != ACCESS_LOGGER or record.levelno >= logging.WARNING
+                or isinstance(status, int) and status >= 400 or random.random() < self.rate):
+            return True
+        self.dropped += 1
+        return False
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record"""
+    FIELDS = ('request_id', 'peer', 'method', 'path', 'status')
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        return json.dumps(entry, default=str)
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogPipeline:
+    """The installed queue handler and listener, with drop counters"""
+    def __init__(self, handler, listener, sampler):
+        self.handler = handler
+        self.listener = listener
+        self.sampler = sampler
+
+    def stats(self):
+        return {
+            'queued': self.handler.queue.qsize(),
+            'dropped': self.handler.dropped,
+            'sampled_out': self.sampler.dropped
+        }
+
+    def stop(self):
+        self.listener.stop()
+
+def setup_logging(path, settings=None, level=logging.INFO):
+    """Route all logging through a queue to a rotated JSON file and the console.
+
+    settings is the 'logging' section of config.json: format ('json' or
+    'text' for the file), rotate ('size' or 'time'), max_mb, when, backups,
+    access_sample_rate and console.
+    """
+    settings = settings or {}
+    if settings.get('rotate', 'size') == 'time':
+        file_handler = TimedRotatingFileHandler(path, when=settings.get('when', 'midnight'),
+                                                backupCount=settings.get('backups', 7))
+    else:
+        file_handler = RotatingFileHandler(path, maxBytes=settings.get('max_mb', 50) * 1024 * 1024,
+                                           backupCount=settings.get('backups', 5))
+    file_handler.setFormatter(JsonFormatter() if settings.get('format', 'json') == 'json'
+                              else logging.Formatter(TEXT_FORMAT))
+    handlers = [file_handler]
+    if settings.get('console', True):
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(logging.Formatter(TEXT_FORMAT))
+        handlers.append(console)
+
+    handler = DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+    sampler = SamplingFilter(settings.get('access_sample_rate', 0.1))
+    handler.addFilter(sampler)
+    handler.addFilter(ContextFilter())
+    listener = QueueListener(handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    return LogPipeline(handler, listener, sampler)
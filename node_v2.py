@@ -2,52 +2,59 @@ import os
 import json
 import hashlib
 import logging
-from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs
-from threading import Thread
+import tempfile
+import shutil
+import gzip
+import argparse
+import multiprocessing
+import random
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote, unquote
+from threading import Thread, Lock, Condition
+from collections import deque, OrderedDict
 import requests
 import time
 import socket
+from storage_layout import normalize_path, location_for, physical_path, resolve, prepare_location, hash_file
+from storage_engine import (StorageIndex, ColdFile, file_entry, tombstone, listing_records,
+                            METADATA_FILE, INDEX_FILE, JOURNAL_FILE)
+from reconcile import IBLT, pair_key, build_table
+from peer_transport import PeerClient, PeerServer, TransportError, PeerBusy
+from hlc import HybridClock, newer, wall_clock
+from planner import latest_versions, plan
+from node_logging import setup_logging, log_context, ACCESS_LOGGER
+from swarm import SwarmDownload, SwarmError, fetch_listing, piece_hashes, MIN_PIECE_SIZE, MAX_PIECE_SIZE
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:  # cold files fall back to gzip
+    zstandard = None
 
 # Configuration
 STORAGE_DIR = 'storage'
-METADATA_FILE = 'metadata.json'
+TMP_DIR = os.path.join(STORAGE_DIR, '.tmp')  # uploads and pulls in progress
+VERSIONS_DIR = 'versions'  # previous versions, mirroring the storage shards
+QUARANTINE_DIR = 'quarantine'  # files that failed scrubbing
+INDEX_COMPACT_RECORDS = 10000  # snapshot once the journal has this many records
+INDEX_COMPACT_INTERVAL = 30  # ...or after this many seconds with any changes
+INDEX_BATCH_SIZE = 1000  # hashed files committed to the journal at once
 CONFIG_FILE = 'config.json'
+LOG_FILE = 'node.log'
 SYNC_INTERVAL = 24 * 60 * 60  # once per day
 PORT = 8000
-
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('node.log'),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
-
-# Ensure directories exist
-os.makedirs(STORAGE_DIR, exist_ok=True)
-
-# Metadata storage
-def load_metadata():
-    if os.path.exists(METADATA_FILE):
-        with open(METADATA_FILE, 'r') as f:
-            return json.load(f)
-    return {}
-
-def save_metadata(metadata):
-    with open(METADATA_FILE, 'w') as f:
-        json.dump(metadata, f, indent=2)
-
-metadata = load_metadata()
+COPY_CHUNK_SIZE = 1024 * 1024
+RECONCILE_START_CELLS = 96  # enough for ~50 differing files
+RECONCILE_MAX_CELLS = 96 * 512
 
 # Load nodes configuration
 def load_config():
     if not os.path.exists(CONFIG_FILE):
-        logger.warning(f"{CONFIG_FILE} not found. Creating default config.")
         default_config = {"nodes": []}
         with open(CONFIG_FILE, 'w') as f:
             json.dump(default_config, f, indent=2)
@@ -56,9 +63,148 @@ def load_config():
     with open(CONFIG_FILE) as f:
         return json.load(f)
 
+config_created = not os.path.exists(CONFIG_FILE)
 config = load_config()
 NODES = config.get('nodes', [])
 
+# Setup logging: records are queued and written by a background thread as
+# JSON lines to a rotated node.log
+log_pipeline = setup_logging(LOG_FILE, config.get('logging'))
+logger = logging.getLogger(__name__)
+access_logger = logging.getLogger(ACCESS_LOGGER)
+if config_created:
+    logger.warning(f"{CONFIG_FILE} not found. Created default config.")
+
+# Ensure directories exist
+os.makedirs(STORAGE_DIR, exist_ok=True)
+os.makedirs(TMP_DIR, exist_ok=True)
+os.makedirs(VERSIONS_DIR, exist_ok=True)
+os.makedirs(QUARANTINE_DIR, exist_ok=True)
+
+# Metadata storage. Keys are relative paths; each entry's 'location' is the
+# file's shard under STORAGE_DIR, so metadata doubles as the location index.
+# The index is shared with the GUIs through storage_engine: changes are
+# appended to a journal and periodically folded into a binary snapshot (and
+# metadata.json), and changes the GUIs journal are picked up every second.
+index = StorageIndex(METADATA_FILE, INDEX_FILE, JOURNAL_FILE)
+metadata = index.entries
+in_flight = index.in_flight  # temp file name -> journal record of writes not finished yet
+metadata_lock = index.lock  # shared by the HTTP handler and the sync thread
+
+def journal_write(*records):
+    index.append(*records)
+
+def compact_index():
+    """Write metadata.json and the binary snapshot, then start an empty journal"""
+    index.compact()
+
+def index_flusher():
+    """Pick up changes from the GUIs; fold the journal into a new snapshot when it grows or ages"""
+    while True:
+        time.sleep(1)
+        try:
+            index.refresh()
+            if index.records >= INDEX_COMPACT_RECORDS or (
+                    index.records and time.time() - index.last_compaction >= INDEX_COMPACT_INTERVAL):
+                compact_index()
+        except Exception as e:
+            logger.error(f"Index snapshot failed: {e}")
+
+# Every stored version carries a hybrid logical clock timestamp; when two
+# nodes hold different versions of a file, the newer one replaces the other
+hlc = HybridClock()
+hlc.update(max((entry.get('clock', 0) for entry in metadata.values()), default=0))
+
+# Version retention: the last N versions, plus the newest version of each
+# day for the last M days
+VERSIONING = config.get('versioning', {})
+VERSION_KEEP_LAST = VERSIONING.get('keep_last', 5)
+VERSION_DAILY_DAYS = VERSIONING.get('daily_days', 14)
+
+# Integrity scrubber: re-verifies stored files within an I/O budget and
+# pauses while the node is busy serving requests
+SCRUB = config.get('scrub', {})
+SCRUB_ENABLED = SCRUB.get('enabled', True)
+SCRUB_MB_PER_SEC = SCRUB.get('mb_per_sec', 20)
+SCRUB_IOPS = SCRUB.get('iops', 100)
+SCRUB_MAX_ACTIVE_REQUESTS = SCRUB.get('max_active_requests', 1)
+SCRUB_MAX_REQUESTS_PER_SEC = SCRUB.get('max_requests_per_sec', 5)
+SCRUB_INTERVAL = SCRUB.get('interval', 7 * 24 * 60 * 60)  # one full pass per week
+
+# Tiered storage: files neither accessed nor modified for a while move to a
+# compressed cold tier, possibly on another mount
+TIERING = config.get('tiering', {})
+TIERING_ENABLED = TIERING.get('enabled', False)
+COLD_AFTER_DAYS = TIERING.get('cold_after_days', 30)
+COLD_DIR = TIERING.get('cold_dir', 'cold')
+COLD_TMP_DIR = os.path.join(COLD_DIR, '.tmp')
+COLD_LEVEL = TIERING.get('level', 3)
+COLD_CODEC = 'zstd' if zstandard else 'gzip'
+TIERING_INTERVAL = TIERING.get('interval', 60 * 60)
+COLD_ERRORS = (OSError, EOFError) + ((zstandard.ZstdError,) if zstandard else ())
+os.makedirs(COLD_TMP_DIR, exist_ok=True)
+
+# In-memory LRU cache of file blocks served by /download
+READ_CACHE = config.get('read_cache', {})
+READ_CACHE_ENABLED = READ_CACHE.get('enabled', False)
+READ_CACHE_BYTES = READ_CACHE.get('max_mb', 256) * 1024 * 1024
+READ_CACHE_MAX_FILE = READ_CACHE.get('max_file_mb', 64) * 1024 * 1024  # larger files bypass it
+
+# Admission control for uploads: requests over the limits wait in a
+# bounded queue and are turned away with 503 once it is full
+ADMISSION = config.get('admission', {})
+ADMISSION_MAX_UPLOADS = ADMISSION.get('max_uploads', 4)
+ADMISSION_MAX_BYTES = ADMISSION.get('max_inflight_mb', 512) * 1024 * 1024
+ADMISSION_QUEUE_SIZE = ADMISSION.get('queue_size', 16)
+ADMISSION_QUEUE_TIMEOUT = ADMISSION.get('queue_timeout', 30)
+ADMISSION_RETRY_AFTER = ADMISSION.get('retry_after', 5)  # seconds suggested to rejected clients
+ADMISSION_DRAIN_BYTES = 8 * 1024 * 1024  # rejected bodies up to this size are read and discarded
+PUSH_RETRIES = ADMISSION.get('push_retries', 4)
+PUSH_MAX_BACKOFF = 120
+
+# Optional binary transport for replication between nodes; the HTTP API
+# stays for clients and GUIs
+TRANSPORT = config.get('transport', {})
+TRANSPORT_ENABLED = TRANSPORT.get('enabled', False)
+TRANSPORT_PORT = TRANSPORT.get('port', PORT + 1000)
+TRANSPORT_PIPELINE = TRANSPORT.get('pipeline', 16)  # files in flight per peer
+
+# Swarm downloads: large files several peers hold are pulled from all of
+# them at once, in pieces
+SWARM = config.get('swarm', {})
+SWARM_ENABLED = SWARM.get('enabled', True)
+SWARM_MIN_SIZE = SWARM.get('min_mb', 64) * 1024 * 1024
+SWARM_PIECE_SIZE = SWARM.get('piece_mb', 4) * 1024 * 1024
+PIECE_CACHE_ENTRIES = 256  # piece listings kept for files being swarmed
+PIECE_INLINE_WAIT = 1  # seconds /pieces waits for hashing before answering 503
+PIECE_RETRY_AFTER = 2  # seconds a peer is asked to wait while a file is hashed
+
+# Deleted files leave a tombstone that sync passes on to peers; it is
+# forgotten once every peer has it, or after max_days in any case
+TOMBSTONES = config.get('tombstones', {})
+TOMBSTONE_MAX_DAYS = TOMBSTONES.get('max_days', 30)
+
+# Cluster-wide planning: instead of syncing pairwise, every node plans the
+# whole cluster's transfers and pulls the ones assigned to it
+PLANNER = config.get('planner', {})
+PLANNER_ENABLED = PLANNER.get('enabled', False)
+PLAN_RETRIES = 5  # attempts at a transfer whose source does not have the file yet
+PLAN_RETRY_DELAY = 2
+PLAN_SECONDS_PER_REQUEST = 1  # queueing assumed for each request a node is serving
+LINK_MIN_SAMPLE = 1024 * 1024  # smaller pulls say little about link speed
+
+# Adaptive sync scheduling: each peer is synced as often as its observed
+# change rate calls for, and unreachable peers are retried with backoff
+SYNC = config.get('sync', {})
+SYNC_MIN_INTERVAL = SYNC.get('min_interval', 60)
+SYNC_MAX_INTERVAL = SYNC.get('max_interval', SYNC_INTERVAL)
+SYNC_TARGET_CHANGES = SYNC.get('target_changes', 10)  # changes a sync should typically find
+SYNC_MAX_BACKOFF = SYNC.get('max_backoff', 60 * 60)
+SYNC_JITTER = 0.2  # intervals vary by this fraction so nodes drift apart
+
+# Hashing processes used to index new or changed files
+INDEX_WORKERS = config.get('index_workers', os.cpu_count() or 1)
+
 # Get local IP
 def get_local_ip():
     try:
@@ -79,40 +225,1160 @@ NODES = [node for node in NODES if node != LOCAL_ADDRESS]
 logger.info(f"Starting node at {LOCAL_ADDRESS}")
 logger.info(f"Connected nodes: {NODES}")
 
-def calculate_hash(filepath):
-    """Calculate MD5 hash of a file"""
+def file_path(filename):
+    """Filesystem path of a stored file"""
+    return resolve(STORAGE_DIR, metadata, filename)
+
+FICLONE = 0x40049409  # linux/fs.h
+
+def clone_file(src_path, dst_fd):
+    """Make dst_fd share all of src_path's blocks (reflink); False if unsupported"""
+    if fcntl is None:
+        return False
+    try:
+        with open(src_path, 'rb') as src:
+            fcntl.ioctl(dst_fd, FICLONE, src.fileno())
+        return True
+    except OSError:
+        return False
+
+def write_temp(chunks, base=None):
+    """Write chunks to a temp file, returning (temp path, hash, size)"""
+    fd, tmp_path = tempfile.mkstemp(dir=TMP_DIR)
+    os.chmod(tmp_path, 0o644)  # mkstemp creates files private to the owner
+    begin_write(tmp_path)
     hash_md5 = hashlib.md5()
-    with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    size = 0
+    # On reflink filesystems start from a clone of the previous version and
+    # only write chunks that changed, so both versions share unchanged blocks
+    cloned = base is not None and os.path.isfile(base) and clone_file(base, fd)
+    try:
+        with os.fdopen(fd, 'r+b' if cloned else 'wb') as f:
+            for chunk in chunks:
+                if cloned:
+                    f.seek(size)
+                    if f.read(len(chunk)) != chunk:
+                        f.seek(size)
+                        f.write(chunk)
+                else:
+                    f.write(chunk)
+                hash_md5.update(chunk)
+                size += len(chunk)
+            if cloned:
+                f.truncate(size)
+    except BaseException:
+        discard_temp(tmp_path)
+        raise
+    return tmp_path, hash_md5.hexdigest(), size
+
+def begin_write(tmp_path, **commit):
+    """Journal a temp file as in flight, or with commit details as about to be stored"""
+    op_id = os.path.basename(tmp_path)
+    record = {'commit': op_id, **commit} if commit else {'begin': op_id}
+    with metadata_lock:
+        in_flight.setdefault(op_id, {}).update(record)
+        journal_write(record)
+
+def end_write(tmp_path):
+    """Journal that a temp file was stored or discarded"""
+    op_id = os.path.basename(tmp_path)
+    with metadata_lock:
+        if in_flight.pop(op_id, None) is not None:
+            journal_write({'end': op_id})
+
+def discard_temp(tmp_path):
+    """Remove a temp file that will not be stored"""
+    os.remove(tmp_path)
+    end_write(tmp_path)
+
+def read_body(rfile, length):
+    """Yield a request body of known length in chunks"""
+    remaining = length
+    while remaining > 0:
+        chunk = rfile.read(min(COPY_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise IOError(f"Connection closed with {remaining} bytes left")
+        remaining -= len(chunk)
+        yield chunk
+
+def version_dir(filename):
+    """Directory holding the versions of a file"""
+    location = metadata.get(filename, {}).get('location') or location_for(filename)
+    return physical_path(VERSIONS_DIR, location)
+
+def version_path(filename, version_id):
+    """Filesystem path of a stored version"""
+    return os.path.join(version_dir(filename), version_id)
+
+def cold_snapshot(filename, new_hash=None):
+    """Decompress a cold file into a temp file before it is replaced or deleted.
+
+    Called without metadata_lock held, so that keep_version() does not
+    decompress the whole file while holding it. Returns (entry, temp path),
+    or None if the file is not cold or already has new_hash.
+    """
+    with metadata_lock:
+        entry = metadata.get(filename)
+        if not entry or entry.get('tier') != 'cold' or entry.get('hash') == new_hash:
+            return None
+        reader = ColdReader(filename, entry)
+    with reader:
+        tmp_path, _, _ = write_temp(iter(lambda: reader.read(COPY_CHUNK_SIZE), b""))
+    return entry, tmp_path
+
+def discard_snapshot(snapshot):
+    """Remove a cold snapshot keep_version() did not use"""
+    if snapshot and os.path.exists(snapshot[1]):
+        discard_temp(snapshot[1])
+
+def keep_version(filename, current_path, snapshot=None):
+    """Keep the current content of a file as a version before it is replaced"""
+    entry = metadata[filename]
+    version_id = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    target = version_path(filename, version_id)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if entry.get('tier') == 'cold':
+        if snapshot and snapshot[0] is entry:
+            os.replace(snapshot[1], target)
+            end_write(snapshot[1])
+        else:
+            # Demoted or replaced since the snapshot was taken
+            with open_stored(filename) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+    else:
+        try:
+            # The live file is always replaced, never rewritten in place, so
+            # the old inode can simply be kept under a second name
+            os.link(current_path, target)
+        except OSError:
+            shutil.copy2(current_path, target)
+    entry.setdefault('versions', []).append({
+        'id': version_id,
+        'hash': entry['hash'],
+        'size': entry.get('size', 0),
+        'created': datetime.now().isoformat()
+    })
+    prune_versions(filename)
+
+def prune_versions(filename):
+    """Drop versions outside the retention policy"""
+    entry = metadata.get(filename, {})
+    versions = sorted(entry.get('versions', []), key=lambda v: v['id'], reverse=True)
+    if not versions:
+        return
+
+    keep = {v['id'] for v in versions[:VERSION_KEEP_LAST]}
+    cutoff = datetime.now() - timedelta(days=VERSION_DAILY_DAYS)
+    days = set()
+    for v in versions:
+        created = datetime.fromisoformat(v['created'])
+        if created >= cutoff and created.date() not in days:
+            days.add(created.date())
+            keep.add(v['id'])
+
+    for v in versions:
+        if v['id'] not in keep:
+            try:
+                os.remove(version_path(filename, v['id']))
+            except FileNotFoundError:
+                pass
+    entry['versions'] = [v for v in reversed(versions) if v['id'] in keep]
+
+def prune_all_versions():
+    """Apply the retention policy to every file (daily snapshots age out)"""
+    with metadata_lock:
+        pruned = []
+        for filename, entry in list(metadata.items()):
+            if entry.get('versions'):
+                before = len(entry['versions'])
+                prune_versions(filename)
+                if len(entry['versions']) != before:
+                    pruned.append(filename)
+        if pruned:
+            index.save(*pruned)
+
+def store_file(filename, tmp_path, file_hash, size, clock=None):
+    """Move a fully written temp file into its shard and index it.
+
+    `clock` is the version's timestamp when it was replicated from a peer;
+    local writes get a new one. A replicated version that loses to the
+    stored one is discarded and False returned.
+    """
+    location, filepath = prepare_location(STORAGE_DIR, filename)
+    snapshot = cold_snapshot(filename, file_hash)
+    try:
+        with metadata_lock:
+            previous = file_path(filename)
+            old_entry = metadata.get(filename, {})
+            if clock is None:
+                clock = hlc.now()
+            else:
+                hlc.update(clock)
+                if not old_entry.get('corrupt') and not newer(clock, file_hash, *version_key(old_entry)):
+                    discard_temp(tmp_path)
+                    return False
+            begin_write(tmp_path, name=filename, hash=file_hash, size=size, clock=clock)
+            if os.path.isfile(stored_path(filename)) and old_entry.get('hash') and old_entry['hash'] != file_hash:
+                keep_version(filename, previous, snapshot)
+            os.replace(tmp_path, filepath)
+            if previous != filepath and os.path.exists(previous):
+                os.remove(previous)  # legacy flat copy
+            if old_entry.get('tier') == 'cold' and os.path.exists(stored_path(filename)):
+                os.remove(stored_path(filename))
+            metadata[filename] = file_entry(file_hash, size, location, os.stat(filepath).st_mtime_ns, clock)
+            if old_entry.get('versions'):
+                metadata[filename]['versions'] = old_entry['versions']
+            index.save(filename)
+            end_write(tmp_path)
+    finally:
+        discard_snapshot(snapshot)
+    read_cache.invalidate(filename)
+    return True
+
+def version_key(entry):
+    """(clock, hash) of a stored entry, the order in which versions win"""
+    return entry.get('clock', 0), entry.get('hash', '')
+
+def delete_file(filename, clock=None):
+    """Delete a file, leaving a tombstone so that sync deletes it on peers.
+
+    A tombstone is an entry with an empty hash and the deletion's clock,
+    so it wins or loses against other versions like any write. `clock` is
+    given for deletions replicated from a peer; returns False if the
+    stored version is newer than the deletion. The deleted content is kept
+    as a version, and the file's versions stay until retention expires them.
+    """
+    snapshot = cold_snapshot(filename)
+    try:
+        with metadata_lock:
+            entry = metadata.get(filename)
+            if not entry:
+                return True  # nothing to delete
+            if clock is None:
+                clock = hlc.now()
+            else:
+                hlc.update(clock)
+                if not newer(clock, '', *version_key(entry)):
+                    return bool(entry.get('deleted'))
+            filepath = stored_path(filename)
+            if os.path.exists(filepath):
+                if entry.get('hash') and not entry.get('corrupt'):
+                    keep_version(filename, filepath, snapshot)
+                os.remove(filepath)
+            metadata[filename] = tombstone(clock)
+            if entry.get('versions'):
+                metadata[filename]['versions'] = entry['versions']
+            index.save(filename)
+    finally:
+        discard_snapshot(snapshot)
+    read_cache.invalidate(filename)
+    return True
+
+def syncable(entry):
+    """True for entries exchanged with peers: intact files and tombstones"""
+    return not entry.get('corrupt') and (entry.get('deleted') or bool(entry.get('location') and entry.get('hash')))
+
+def stored_path(filename):
+    """Filesystem path holding a file's data, in whichever tier it is"""
+    entry = metadata.get(filename, {})
+    if entry.get('tier') == 'cold':
+        return physical_path(COLD_DIR, entry['cold_location'])
+    return file_path(filename)
+
+def open_stored(filename, promote=False):
+    """Open a stored file for reading, decompressing it if it is cold"""
+    with metadata_lock:
+        entry = metadata.get(filename, {})
+        if entry.get('tier') == 'cold':
+            return ColdReader(filename, entry, promote)
+        return open(file_path(filename), 'rb')
+
+def stream_size(f):
+    """Size of the content behind a stream from open_stored()"""
+    return len(f) if isinstance(f, ColdReader) else os.fstat(f.fileno()).st_size
+
+class ColdReader(ColdFile):
+    """Readable stream over the decompressed content of a cold file.
+
+    With promote=True the content is also written to a temp file, which
+    replaces the cold copy in the hot tier once it has been read to the end.
+    """
+    def __init__(self, filename, entry, promote=False):
+        super().__init__(COLD_DIR, entry)
+        self.filename = filename
+        self.promotion = None
+        if promote:
+            fd, self.tmp_path = tempfile.mkstemp(dir=TMP_DIR)
+            os.chmod(self.tmp_path, 0o644)
+            begin_write(self.tmp_path)
+            self.promotion = os.fdopen(fd, 'wb')
+            self.hash_md5 = hashlib.md5()
+    
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if self.promotion:
+            if data:
+                self.promotion.write(data)
+                self.hash_md5.update(data)
+            elif size != 0:
+                self.promotion.close()
+                self.promotion = None
+                if self.hash_md5.hexdigest() == self.entry.get('hash'):
+                    promote_file(self.filename, self.entry, self.tmp_path)
+                else:
+                    discard_temp(self.tmp_path)
+        return data
+    
+    def close(self):
+        if self.promotion:
+            self.promotion.close()
+            self.promotion = None
+            discard_temp(self.tmp_path)
+        super().close()
+
+def promote_file(filename, entry, tmp_path):
+    """Move a decompressed cold file back into the hot tier"""
+    with metadata_lock:
+        if metadata.get(filename) is not entry or entry.get('tier') != 'cold':
+            discard_temp(tmp_path)  # replaced while it was being read
+            return
+        cold_file = stored_path(filename)
+        location, filepath = prepare_location(STORAGE_DIR, filename)
+        os.replace(tmp_path, filepath)
+        for key in ('tier', 'cold_location', 'codec'):
+            entry.pop(key, None)
+        entry.update({'location': location, 'mtime_ns': os.stat(filepath).st_mtime_ns})
+        index.save(filename)
+        end_write(tmp_path)
+        os.remove(cold_file)
+    logger.info(f"Promoted '{filename}' to the hot tier")
+
+def demote_file(filename, entry):
+    """Compress a hot file into the cold tier; False if it changed meanwhile"""
+    source = file_path(filename)
+    before = os.stat(source)
+    cold_location = location_for(filename) + ('.zst' if COLD_CODEC == 'zstd' else '.gz')
+    target = physical_path(COLD_DIR, cold_location)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    
+    fd, tmp_path = tempfile.mkstemp(dir=COLD_TMP_DIR)
+    try:
+        with open(source, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            if COLD_CODEC == 'zstd':
+                zstandard.ZstdCompressor(level=COLD_LEVEL).copy_stream(src, dst)
+            else:
+                with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=COLD_LEVEL) as gz:
+                    shutil.copyfileobj(src, gz, COPY_CHUNK_SIZE)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    
+    with metadata_lock:
+        try:
+            after = os.stat(source)
+        except FileNotFoundError:
+            after = None
+        if (metadata.get(filename) is not entry or after is None
+                or (after.st_ino, after.st_mtime_ns) != (before.st_ino, before.st_mtime_ns)):
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, target)
+        entry.update({'tier': 'cold', 'cold_location': cold_location, 'codec': COLD_CODEC})
+        index.save(filename)
+        os.remove(source)
+    read_cache.invalidate(filename)
+    return True
+
+def mark_accessed(filename):
+    """Record a client read (journaled at most hourly per file)"""
+    with metadata_lock:
+        entry = metadata.get(filename)
+        now = datetime.now()
+        if entry and (not entry.get('accessed')
+                      or now - datetime.fromisoformat(entry['accessed']) > timedelta(hours=1)):
+            entry['accessed'] = now.isoformat()
+            index.save(filename)
+
+def tier_loop():
+    """Move files that have been neither accessed nor modified for a while to the cold tier"""
+    while True:
+        cutoff = datetime.now() - timedelta(days=COLD_AFTER_DAYS)
+        moved = saved = 0
+        for filename in list(metadata):
+            entry = metadata.get(filename)
+            if not entry or entry.get('tier') == 'cold' or entry.get('corrupt') or not entry.get('hash'):
+                continue
+            last_used = max(entry.get('accessed', ''), entry.get('modified', ''))
+            if not last_used or datetime.fromisoformat(last_used) >= cutoff:
+                continue
+            wait_for_quiet()
+            try:
+                if demote_file(filename, entry):
+                    moved += 1
+                    saved += entry.get('size', 0) - os.path.getsize(stored_path(filename))
+            except Exception as e:
+                logger.error(f"Could not move '{filename}' to the cold tier: {e}")
+        if moved:
+            logger.info(f"Moved {moved} files to the cold tier ({saved / 1024**2:.1f} MB saved)")
+        time.sleep(TIERING_INTERVAL)
+
+def restore_version(filename, version_id):
+    """Make a stored version current again, keeping the current one as a version"""
+    with metadata_lock:
+        entry = metadata[filename]
+        version = next(v for v in entry.get('versions', []) if v['id'] == version_id)
+        source = version_path(filename, version_id)
+    # A copy, not a link: the restored file must not share its inode with
+    # the kept version. It is made without metadata_lock held, since the
+    # version may be large; store_file() takes the lock to swap it in.
+    fd, tmp_path = tempfile.mkstemp(dir=TMP_DIR)
+    os.chmod(tmp_path, 0o644)
+    begin_write(tmp_path)
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            if not clone_file(source, dst.fileno()):
+                with open(source, 'rb') as src:
+                    shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+    except BaseException:
+        discard_temp(tmp_path)
+        raise
+    store_file(filename, tmp_path, version['hash'], version['size'])
+    return metadata[filename]
+
+def migrate_flat_storage():
+    """Move files from the old flat layout into shard directories"""
+    with os.scandir(STORAGE_DIR) as entries:
+        flat_files = [entry.name for entry in entries if entry.is_file()]
+    
+    with metadata_lock:
+        for filename in flat_files:
+            location, filepath = prepare_location(STORAGE_DIR, filename)
+            os.replace(os.path.join(STORAGE_DIR, filename), filepath)
+            metadata.setdefault(filename, {}).update({
+                'location': location,
+                'size': os.path.getsize(filepath)
+            })
+        if flat_files:
+            index.save(*flat_files)
+            logger.info(f"Moved {len(flat_files)} files into sharded storage")
+
+def recover_in_flight():
+    """Roll back or finish the writes that were in flight when the node stopped"""
+    for op_id, record in list(in_flight.items()):
+        tmp_path = os.path.join(TMP_DIR, op_id)
+        if 'commit' not in record:
+            # Upload or pull cut off before it was accepted
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            logger.info(f"Rolled back interrupted write {op_id}")
+        elif os.path.exists(tmp_path):
+            # Accepted but not moved into place yet
+            store_file(record['name'], tmp_path, record['hash'], record['size'], record.get('clock'))
+            logger.info(f"Finished interrupted write of '{record['name']}'")
+        else:
+            # Moved into place; make sure the index agrees
+            filename = record['name']
+            filepath = physical_path(STORAGE_DIR, location_for(filename))
+            if os.path.isfile(filepath) and metadata.get(filename, {}).get('hash') != record['hash']:
+                with metadata_lock:
+                    metadata.setdefault(filename, {}).update(file_entry(
+                        record['hash'], record['size'], location_for(filename),
+                        os.stat(filepath).st_mtime_ns, record.get('clock', 0)))
+                    index.save(filename)
+                logger.info(f"Finished interrupted write of '{filename}'")
+        end_write(tmp_path)
+    
+    # Temp files the journal does not know about
+    for tmp_dir in (TMP_DIR, COLD_TMP_DIR):
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+
+def verify_index(workers=1):
+    """Check entries against their files, rehashing only new or changed files.
+
+    Files are stat-compared first; the ones that need hashing are spread
+    over `workers` processes and committed in batches, so an interrupted
+    run picks up where it stopped.
+    """
+    changed = 0
+    pending = []
+    for filename in list(metadata):
+        entry = metadata.get(filename)
+        if not entry or entry.get('corrupt') or entry.get('deleted'):
+            continue
+        filepath = stored_path(filename)
+        try:
+            st = os.stat(filepath)
+        except FileNotFoundError:
+            # Gone from disk: forget it so the next sync pulls it again
+            with metadata_lock:
+                if metadata.get(filename) is entry:
+                    del metadata[filename]
+                    index.save(filename)
+            logger.warning(f"'{filename}' is missing from storage, dropped from the index")
+            changed += 1
+            continue
+        if entry.get('tier') == 'cold':
+            continue  # compressed; the scrubber checks its content
+        
+        if entry.get('hash') and entry.get('size') == st.st_size:
+            if entry.get('mtime_ns') == st.st_mtime_ns:
+                continue
+            if 'mtime_ns' not in entry:
+                # Indexed before mtimes were recorded; trust the stored hash
+                with metadata_lock:
+                    if metadata.get(filename) is entry:
+                        entry['mtime_ns'] = st.st_mtime_ns
+                        index.save(filename)
+                continue
+        pending.append((filename, entry, filepath, st.st_size))
+    
+    if pending:
+        changed += hash_pending(pending, workers)
+    logger.info(f"Index verified against storage ({changed} entries changed)")
+
+def hash_pending(pending, workers):
+    """Hash (filename, entry, path, size) jobs and commit them in batches; returns changed count"""
+    total_bytes = sum(size for _, _, _, size in pending)
+    logger.info(f"Indexing {len(pending)} files ({total_bytes / 1024**3:.1f} GB) with {workers} workers")
+    if workers > 1:
+        # fork where available: spawned workers would re-run this module
+        methods = multiprocessing.get_all_start_methods()
+        pool = multiprocessing.get_context('fork' if 'fork' in methods else None).Pool(workers)
+    else:
+        pool = None
+    paths = [filepath for _, _, filepath, _ in pending]
+    results = pool.imap(hash_file, paths, chunksize=4) if pool else map(hash_file, paths)
+    
+    started = last_report = time.time()
+    done = done_bytes = changed = 0
+    batch = []
+    try:
+        for (filename, entry, _, _), result in zip(pending, results):
+            done += 1
+            if result:
+                batch.append((filename, entry, result))
+                done_bytes += result[1]
+            if len(batch) >= INDEX_BATCH_SIZE or done == len(pending):
+                if pool is None:
+                    wait_for_quiet()
+                with metadata_lock:
+                    committed = []
+                    for filename, entry, (file_hash, size, mtime_ns) in batch:
+                        if metadata.get(filename) is not entry:
+                            continue  # replaced while we were hashing
+                        if not entry.get('hash'):
+                            # Never indexed: date it by its mtime, so a stale
+                            # tree does not win over newer copies on peers
+                            entry['modified'] = datetime.fromtimestamp(mtime_ns / 1e9).isoformat()
+                            entry['clock'] = wall_clock(mtime_ns / 1e9)
+                            changed += 1
+                        elif file_hash != entry['hash']:
+                            entry['modified'] = datetime.now().isoformat()
+                            entry['clock'] = hlc.now()  # edited in place
+                            changed += 1
+                        entry.update({'hash': file_hash, 'size': size, 'mtime_ns': mtime_ns})
+                        entry.setdefault('uploaded', entry['modified'] if 'modified' in entry else datetime.now().isoformat())
+                        committed.append(filename)
+                    if committed:
+                        index.save(*committed)
+                batch = []
+            if time.time() - last_report >= 5 or done == len(pending):
+                last_report = time.time()
+                rate = done_bytes / 1024**2 / max(last_report - started, 0.001)
+                logger.info(f"Indexed {done}/{len(pending)} files "
+                            f"({done_bytes / 1024**3:.1f}/{total_bytes / 1024**3:.1f} GB, {rate:.0f} MB/s)")
+    finally:
+        if pool:
+            pool.terminate()
+    return changed
+
+# Set reconciliation. Peers compare IBLTs of their (name, hash) pairs, so
+# the traffic depends on the number of differences, not of files.
+reconcile_cache = {'version': None, 'pairs': {}, 'tables': {}}
+reconcile_lock = Lock()
+
+def local_pairs():
+    """Map of pair key -> (name, hash) for every file this node serves"""
+    with reconcile_lock:
+        if reconcile_cache['version'] != index.listing_version:
+            with metadata_lock:
+                version = index.listing_version
+                pairs = {pair_key(name, entry['hash']): (name, entry['hash'])
+                         for name, entry in metadata.items() if syncable(entry)}
+            reconcile_cache.update({'version': version, 'pairs': pairs, 'tables': {}})
+        return reconcile_cache['pairs']
+
+def local_table(size):
+    """IBLT of the local pairs, cached until metadata changes"""
+    pairs = local_pairs()
+    with reconcile_lock:
+        table = reconcile_cache['tables'].get(size)
+        if table is None:
+            table = reconcile_cache['tables'][size] = build_table(pairs, size)
+        return table
+
+def reconcile_against(theirs):
+    """Peel a peer's IBLT against ours: ([(name, hash, size, clock)] they lack, [keys] we lack), or None"""
+    pairs = local_pairs()
+    diff = local_table(theirs.size).subtract(theirs).decode()
+    if diff is None or not all(key in pairs for key in diff[0]):
+        return None
+    have = []
+    for key in diff[0]:
+        name, file_hash = pairs[key]
+        entry = metadata.get(name, {})
+        have.append((name, file_hash, entry.get('size', 0), entry.get('clock', 0)))
+    return have, list(diff[1])
+
+def remote_differences(node, peer=None):
+    """Reconcile with a peer: (names it lacks, {name: (hash, size, clock)} we lack), or None if unsupported"""
+    size = RECONCILE_START_CELLS
+    while size <= RECONCILE_MAX_CELLS:
+        pairs = local_pairs()
+        if peer:
+            result = peer.reconcile(local_table(size).to_bytes())
+        else:
+            resp = requests.post(f"http://{node}/reconcile", data=local_table(size).to_bytes(),
+                                 headers={'Content-Type': 'application/octet-stream'}, timeout=30)
+            if resp.status_code != 200:
+                return None  # peer predates reconciliation
+            result = resp.json()
+            result = (result['have'], [int(key, 16) for key in result['need']]) if result['decoded'] else None
+        if result:
+            have, need = result
+            if all(key in pairs for key in need):
+                logger.info(f"Reconciled with {node} using {size} cells")
+                return [pairs[key][0] for key in need], {name: tuple(version) for name, *version in have}
+        size *= 2
+    return None
+
+class TransportHandler:
+    """Serves peer transport requests from local storage"""
+    def list_files(self):
+        for filename in sorted_names():
+            file_meta = metadata.get(filename)
+            if file_meta and syncable(file_meta):
+                yield filename, file_meta.get('hash', ''), file_meta.get('size', 0), file_meta.get('clock', 0)
+    
+    def reconcile(self, table_bytes):
+        return reconcile_against(IBLT.from_bytes(table_bytes))
+    
+    def open_file(self, filename):
+        filename = normalize_path(filename)
+        if not filename or not os.path.isfile(stored_path(filename)):
+            return None
+        f = open_stored(filename)
+        return f, metadata.get(filename, {}).get('hash', ''), stream_size(f)
+    
+    def store_file(self, filename, expected_hash, expected_size, clock, chunks):
+        filename = normalize_path(filename)
+        if not filename:
+            raise ValueError("Invalid filename")
+        if not admission.acquire(expected_size):
+            logger.warning(f"Upload of '{filename}' rejected, node busy")
+            raise PeerBusy(ADMISSION_RETRY_AFTER)
+        try:
+            tmp_path, file_hash, size = write_temp(chunks, base=file_path(filename))
+        finally:
+            admission.release(expected_size)
+        if expected_hash and file_hash != expected_hash:
+            discard_temp(tmp_path)
+            raise ValueError(f"Hash mismatch storing '{filename}'")
+        if not store_file(filename, tmp_path, file_hash, size, clock):
+            # Answer with the version we kept so the sender knows
+            entry = metadata.get(filename, {})
+            return entry.get('hash', ''), entry.get('size', 0)
+        logger.info(f"Stored file: {filename} ({size} bytes, hash: {file_hash})")
+        return file_hash, size
+
+peer_clients = {}
+
+def peer_client(node):
+    """Open or reuse the binary transport to a peer; None to use HTTP"""
+    if not TRANSPORT_ENABLED:
+        return None
+    client = peer_clients.get(node)
+    if client and not client.closed:
+        return client
+    try:
+        port = requests.get(f"http://{node}/health", timeout=5).json().get('transport_port')
+        if not port:
+            return None
+        client = peer_clients[node] = PeerClient(node.rsplit(':', 1)[0], port)
+        logger.info(f"Connected to {node} over the peer transport (port {port})")
+        return client
+    except (requests.RequestException, OSError, ValueError) as e:
+        logger.warning(f"Peer transport to {node} unavailable, using HTTP: {e}")
+        return None
+
+def replicate_over_transport(node, peer, to_push, to_pull):
+    """Push and pull files through the peer transport, keeping several in flight"""
+    pending = deque()
+    overloaded = False
+    
+    def start_push(filename):
+        with open_stored(filename) as f:
+            file_meta = metadata.get(filename, {})
+            file_hash, clock = file_meta.get('hash', ''), file_meta.get('clock', 0)
+            return file_hash, peer.start_put(filename, f, file_hash, stream_size(f), clock)
+    
+    def finish_push():
+        # Like push_file(): back off while the peer is busy, and give up
+        # on the remaining pushes if it stays busy
+        nonlocal overloaded
+        filename, file_hash, stream = pending.popleft()
+        try:
+            for attempt in range(PUSH_RETRIES + 1):
+                try:
+                    kept_hash = peer.finish_put(stream)[0]
+                    break
+                except PeerBusy as e:
+                    if overloaded or attempt == PUSH_RETRIES:
+                        overloaded = True
+                        return
+                    delay = retry_delay(e.retry_after, attempt)
+                    logger.info(f"{node} is busy, retrying '{filename}' in {delay:.1f}s")
+                    time.sleep(delay)
+                    file_hash, stream = start_push(filename)
+            if kept_hash == file_hash:
+                logger.info(f"✓ Pushed '{filename}' to {node}")
+            else:
+                logger.info(f"{node} kept a newer version of '{filename}'")
+        except (OSError, TransportError) as e:
+            logger.error(f"Error pushing '{filename}' to {node}: {e}")
+    
+    for filename in to_push:
+        if overloaded:
+            logger.warning(f"{node} is overloaded, deferring the remaining "
+                           f"pushes to the next sync cycle")
+            break
+        try:
+            pending.append((filename, *start_push(filename)))
+        except (OSError, TransportError) as e:
+            logger.error(f"Error pushing '{filename}' to {node}: {e}")
+        if len(pending) >= TRANSPORT_PIPELINE:
+            finish_push()
+    while pending:
+        finish_push()
+    
+    def finish_pull():
+        filename, local_name, file_hash, clock, stream = pending.popleft()
+        try:
+            _, size, chunks = peer.finish_get(stream)
+            tmp_path, new_hash, size = write_temp(chunks, base=file_path(local_name))
+            if file_hash and new_hash != file_hash:
+                discard_temp(tmp_path)
+                logger.warning(f"Hash mismatch pulling '{filename}' from {node}")
+                return
+            if store_file(local_name, tmp_path, new_hash, size, clock):
+                logger.info(f"✓ Pulled '{filename}' from {node}")
+        except (OSError, TransportError) as e:
+            logger.error(f"Error pulling '{filename}' from {node}: {e}")
+    
+    for filename, (file_hash, size, clock) in to_pull.items():
+        local_name = normalize_path(filename)
+        if not local_name:
+            logger.warning(f"Skipping invalid path '{filename}' from {node}")
+            continue
+        if swarm_pull(node, filename, local_name, file_hash, size, clock):
+            continue
+        pending.append((filename, local_name, file_hash, clock, peer.start_get(filename)))
+        if len(pending) >= TRANSPORT_PIPELINE:
+            finish_pull()
+    while pending:
+        finish_pull()
+
+def swarm_pull(node, filename, local_name, file_hash, size, clock):
+    """Pull a large file from every peer holding it at once.
+
+    Returns False if the file should be pulled from `node` alone: it is
+    small, no other peer has the same version, or the swarm failed.
+    """
+    if not SWARM_ENABLED or size < SWARM_MIN_SIZE or len(NODES) < 2:
+        return False
+    # Only hot copies can serve byte ranges
+    holders = []
+    for peer in NODES:
+        try:
+            resp = requests.get(f"http://{peer}/versions", params={'filename': filename}, timeout=5)
+            # A deleted file that still has versions has no current version
+            current = (resp.json().get('current') or {}) if resp.status_code == 200 else {}
+        except (requests.RequestException, ValueError, KeyError):
+            continue
+        if current.get('hash') == file_hash and current.get('tier', 'hot') == 'hot':
+            holders.append(peer)
+    if len(holders) < 2:
+        return False
+    
+    fd, tmp_path = tempfile.mkstemp(dir=TMP_DIR)
+    os.chmod(tmp_path, 0o644)  # mkstemp creates files private to the owner
+    begin_write(tmp_path)
+    started = time.time()
+    try:
+        with os.fdopen(fd, 'r+b') as f:
+            listing = fetch_listing(node if node in holders else holders[0], filename, SWARM_PIECE_SIZE)
+            if listing['hash'] != file_hash:
+                raise SwarmError(f"Listing is for another version of '{filename}'")
+            stats = SwarmDownload(listing, holders).run(f)
+        if hash_file(tmp_path, COPY_CHUNK_SIZE)[0] != file_hash:
+            raise SwarmError(f"Hash mismatch assembling '{filename}'")
+    except (requests.RequestException, ValueError, KeyError, OSError, SwarmError) as e:
+        discard_temp(tmp_path)
+        logger.warning(f"Swarm download of '{filename}' failed, pulling from {node} alone: {e}")
+        return False
+    
+    if store_file(local_name, tmp_path, file_hash, size, clock):
+        seconds = time.time() - started
+        shares = ', '.join(f"{peer}: {peer_stats['bytes'] / 1024**2:.0f} MB"
+                           for peer, peer_stats in stats.items())
+        logger.info(f"✓ Pulled '{filename}' from {len(holders)} peers in {seconds:.1f}s "
+                    f"({size / 1024**2 / max(seconds, 0.001):.0f} MB/s; {shares})")
+    return True
+
+piece_cache = OrderedDict()  # (name, hash, piece size) -> piece hashes
+piece_jobs = {}  # (name, hash, piece size) -> thread hashing it
+piece_cache_lock = Lock()
+
+def file_pieces(filename, file_hash, piece_size):
+    """Piece hashes of a stored file, cached while swarms fetch it.
+
+    Hashing a multi-GB file takes longer than a peer waits for the listing,
+    so it runs in the background; returns None while it is still running.
+    """
+    key = (filename, file_hash, piece_size)
+    with piece_cache_lock:
+        if key in piece_cache:
+            piece_cache.move_to_end(key)
+            return piece_cache[key]
+        job = piece_jobs.get(key)
+        if job is None:
+            job = piece_jobs[key] = Thread(target=hash_pieces, args=key, daemon=True)
+            job.start()
+    job.join(PIECE_INLINE_WAIT)  # small files are answered straight away
+    with piece_cache_lock:
+        return piece_cache.get(key)
+
+def hash_pieces(filename, file_hash, piece_size):
+    """Compute a file's piece hashes into piece_cache"""
+    key = (filename, file_hash, piece_size)
+    try:
+        with open_stored(filename) as f:
+            pieces = piece_hashes(f, piece_size)
+        if metadata.get(filename, {}).get('hash') == file_hash:  # not replaced meanwhile
+            with piece_cache_lock:
+                piece_cache[key] = pieces
+                if len(piece_cache) > PIECE_CACHE_ENTRIES:
+                    piece_cache.popitem(last=False)
+    except OSError as e:
+        logger.warning(f"Could not hash the pieces of '{filename}': {e}")
+    finally:
+        with piece_cache_lock:
+            piece_jobs.pop(key, None)
 
-def sanitize_filename(filename):
-    """Sanitize filename to prevent path traversal"""
-    return os.path.basename(filename)
+def parse_range(header, size):
+    """(first, last) byte of a single 'bytes=' Range header, or None to send everything.
+
+    An unsatisfiable range comes back with first > last.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[len('bytes='):].partition('-')
+    try:
+        if not first:
+            return max(0, size - int(last)), size - 1  # suffix: the last N bytes
+        return int(first), min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+
+# Name-sorted listings, compared with a merge-join when reconciliation fails
+listing_cache = {'version': None, 'names': []}
+
+def sorted_names():
+    """Stored file names in sorted order, cached until metadata changes"""
+    with reconcile_lock:
+        if listing_cache['version'] != index.listing_version:
+            with metadata_lock:
+                listing_cache.update({'version': index.listing_version, 'names': sorted(metadata)})
+        return listing_cache['names']
+
+def file_info(filename, file_meta):
+    """Listing record of a stored file"""
+    return {
+        'name': filename,
+        'size': file_meta.get('size', 0),
+        'hash': file_meta.get('hash', ''),
+        'uploaded': file_meta.get('uploaded', ''),
+        'modified': file_meta.get('modified', ''),
+        'clock': file_meta.get('clock', 0),
+        'deleted': file_meta.get('deleted', False)
+    }
+
+def local_listing():
+    """Yield (name, hash, size, clock) for every local file, sorted by name"""
+    for filename in sorted_names():
+        file_meta = metadata.get(filename)
+        if file_meta and syncable(file_meta):
+            yield filename, file_meta['hash'], file_meta.get('size', 0), file_meta.get('clock', 0)
+
+def remote_versions(resp):
+    """Yield (name, hash, size, clock) from a peer's /files response, sorted by name"""
+    for f in listing_records(resp):
+        yield f['name'], f.get('hash', ''), f.get('size', 0), f.get('clock', 0)
+
+def diff_listings(local, remote):
+    """Merge-join two name-sorted (name, hash, size, clock) streams.
+
+    Yields (name, local (hash, size, clock), remote (hash, size, clock))
+    for every name whose hashes differ, with None for the side that lacks
+    the file.
+    """
+    local, remote = iter(local), iter(remote)
+    mine, theirs = next(local, None), next(remote, None)
+    while mine or theirs:
+        if theirs is None or (mine and mine[0] < theirs[0]):
+            yield mine[0], mine[1:], None
+            mine = next(local, None)
+        elif mine is None or theirs[0] < mine[0]:
+            yield theirs[0], None, theirs[1:]
+            theirs = next(remote, None)
+        else:
+            if mine[1] != theirs[1]:
+                yield mine[0], mine[1:], theirs[1:]
+            mine, theirs = next(local, None), next(remote, None)
+
+class ReadCache:
+    """Byte-budgeted LRU cache of file blocks.
+
+    Blocks are keyed by file name, a (inode, mtime, size) token and block
+    index; stored files are always replaced by a rename, so a new version
+    never matches blocks cached for the old one.
+    """
+    def __init__(self, max_bytes, block_size):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.blocks = OrderedDict()
+        self.keys_by_file = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+    
+    def read_block(self, filename, token, f, index):
+        key = (filename, token, index)
+        with self.lock:
+            data = self.blocks.get(key)
+            if data is not None:
+                self.blocks.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+        
+        f.seek(index * self.block_size)
+        data = f.read(self.block_size)
+        with self.lock:
+            if key not in self.blocks:
+                self.blocks[key] = data
+                self.keys_by_file.setdefault(filename, set()).add(key)
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    self._remove(next(iter(self.blocks)))
+                    self.evictions += 1
+        return data
+    
+    def _remove(self, key):
+        self.size -= len(self.blocks.pop(key))
+        keys = self.keys_by_file[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self.keys_by_file[key[0]]
+    
+    def invalidate(self, filename):
+        """Drop every cached block of a file"""
+        with self.lock:
+            for key in list(self.keys_by_file.get(filename, ())):
+                self._remove(key)
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': READ_CACHE_ENABLED,
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'blocks': len(self.blocks),
+                'files': len(self.keys_by_file),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+read_cache = ReadCache(READ_CACHE_BYTES, COPY_CHUNK_SIZE)
+
+def read_chunks(filename, f):
+    """Yield a stored file's content, through the read cache when it fits"""
+    if READ_CACHE_ENABLED and not isinstance(f, ColdReader):
+        st = os.fstat(f.fileno())
+        if st.st_size <= READ_CACHE_MAX_FILE:
+            token = (st.st_ino, st.st_mtime_ns, st.st_size)
+            for index in range((st.st_size + COPY_CHUNK_SIZE - 1) // COPY_CHUNK_SIZE):
+                yield read_cache.read_block(filename, token, f, index)
+            return
+    yield from iter(lambda: f.read(COPY_CHUNK_SIZE), b"")
+
+# Request load, used by background work to stay out of the way
+active_requests = 0
+recent_requests = deque()  # start times of requests in the last second
+request_load_lock = Lock()
+
+def request_load():
+    """Return (requests in flight, requests started in the last second)"""
+    with request_load_lock:
+        cutoff = time.time() - 1
+        while recent_requests and recent_requests[0] < cutoff:
+            recent_requests.popleft()
+        return active_requests, len(recent_requests)
+
+class AdmissionControl:
+    """Limits concurrent uploads and the bytes they have in flight.
+
+    A request over the limits waits in a bounded queue for others to
+    finish; it is rejected when the queue is full or the wait times out.
+    A single request larger than the byte limit is admitted once nothing
+    else is in flight.
+    """
+    def __init__(self, max_active, max_bytes, queue_size, queue_timeout):
+        self.max_active = max_active
+        self.max_bytes = max_bytes
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.bytes = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.changed = Condition()
+    
+    def _fits(self, size):
+        return self.active < self.max_active and (self.bytes + size <= self.max_bytes or not self.bytes)
+    
+    def acquire(self, size):
+        """Admit a request of `size` bytes, waiting if needed; False if the node is too busy"""
+        with self.changed:
+            if not self._fits(size):
+                if self.waiting >= self.queue_size:
+                    self.rejected += 1
+                    return False
+                self.waiting += 1
+                try:
+                    fits = self.changed.wait_for(lambda: self._fits(size), self.queue_timeout)
+                finally:
+                    self.waiting -= 1
+                if not fits:
+                    self.rejected += 1
+                    return False
+            self.active += 1
+            self.bytes += size
+            self.admitted += 1
+            return True
+    
+    def release(self, size):
+        with self.changed:
+            self.active -= 1
+            self.bytes -= size
+            self.changed.notify_all()
+    
+    def stats(self):
+        with self.changed:
+            return {
+                'active': self.active,
+                'inflight_bytes': self.bytes,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'rejected': self.rejected
+            }
+
+admission = AdmissionControl(ADMISSION_MAX_UPLOADS, ADMISSION_MAX_BYTES,
+                             ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT)
 
 class BackupHandler(BaseHTTPRequestHandler):
     def log_message(self, format, *args):
         """Override to use our logger"""
         logger.info("%s - %s" % (self.address_string(), format % args))
     
+    def log_error(self, format, *args):
+        logger.warning("%s - %s" % (self.address_string(), format % args))
+    
+    def log_request(self, code='-', size='-'):
+        """Access log line, sampled by the logging pipeline"""
+        access_logger.info(f"{self.address_string()} - \"{self.requestline}\" {code} {size}",
+                           extra={'method': self.command, 'path': self.path, 'status': getattr(code, 'value', code)})
+    
+    def parse_request(self):
+        # Keep the caller's request ID, so one transfer can be followed across nodes
+        if not super().parse_request():
+            return False
+        if self.headers.get('X-Request-ID'):
+            self.log_fields['request_id'] = self.headers['X-Request-ID'][:64]
+        return True
+    
+    def handle_one_request(self):
+        """Track request load around each request"""
+        global active_requests
+        with request_load_lock:
+            active_requests += 1
+            recent_requests.append(time.time())
+        try:
+            with log_context(request_id=os.urandom(6).hex(), peer=self.client_address[0]) as self.log_fields:
+                super().handle_one_request()
+        finally:
+            with request_load_lock:
+                active_requests -= 1
+    
+    def reject_upload(self, length, code, message, headers=None):
+        """Answer an upload without storing its body"""
+        # Discard small bodies so the client reliably sees the answer;
+        # larger ones are cut off by closing the connection
+        if length <= ADMISSION_DRAIN_BYTES:
+            for chunk in read_body(self.rfile, length):
+                pass
+        self.close_connection = True
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(message)
+    
     def do_GET(self):
         parsed = urlparse(self.path)
         
         if parsed.path == '/files':
-            # Return list of files with metadata
+            query = parse_qs(parsed.query)
+            if query.get('format', [''])[0] == 'ndjson':
+                # Name-sorted, one file per line, streamed so neither side
+                # holds the whole listing
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.end_headers()
+                batch = []
+                # Tombstones are included, flagged as deleted, for syncing peers
+                for filename in sorted_names():
+                    file_meta = metadata.get(filename)
+                    if file_meta and syncable(file_meta):
+                        batch.append(json.dumps(file_info(filename, file_meta)) + '\n')
+                        if len(batch) >= 1000:
+                            self.wfile.write(''.join(batch).encode())
+                            batch = []
+                self.wfile.write(''.join(batch).encode())
+                return
+            
+            # Return list of files with metadata (names are relative paths)
             files_info = []
-            for filename in os.listdir(STORAGE_DIR):
-                filepath = os.path.join(STORAGE_DIR, filename)
-                if os.path.isfile(filepath):
-                    file_meta = metadata.get(filename, {})
-                    files_info.append({
-                        'name': filename,
-                        'size': os.path.getsize(filepath),
-                        'hash': file_meta.get('hash', ''),
-                        'uploaded': file_meta.get('uploaded', ''),
-                        'modified': file_meta.get('modified', '')
-                    })
+            for filename, file_meta in list(metadata.items()):
+                if file_meta.get('location') and not file_meta.get('corrupt'):
+                    files_info.append(file_info(filename, file_meta))
             
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
@@ -129,78 +1395,201 @@ class BackupHandler(BaseHTTPRequestHandler):
                 self.wfile.write(b"Missing filename")
                 return
             
-            filename = sanitize_filename(filename)
-            filepath = os.path.join(STORAGE_DIR, filename)
+            filename = normalize_path(filename)
+            filepath = stored_path(filename) if filename else None
+            # Peers replicating don't count as access, so they never promote
+            replica = query.get('replica', [''])[0] == '1'
             
-            if not os.path.exists(filepath):
+            if not filepath or not os.path.isfile(filepath):
                 self.send_response(404)
                 self.end_headers()
                 self.wfile.write(b"File not found")
                 return
             
             try:
-                with open(filepath, 'rb') as f:
-                    data = f.read()
-                
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/octet-stream')
-                self.send_header('Content-Length', str(len(data)))
-                self.end_headers()
-                self.wfile.write(data)
+                if not replica:
+                    mark_accessed(filename)
+                with open_stored(filename, promote=not replica) as f:
+                    size = stream_size(f)
+                    # Cold files are compressed and can only be read in order
+                    byte_range = None if isinstance(f, ColdReader) else parse_range(self.headers.get('Range'), size)
+                    if byte_range and byte_range[0] > byte_range[1]:
+                        self.send_response(416)
+                        self.send_header('Content-Range', f"bytes */{size}")
+                        self.end_headers()
+                        return
+                    if byte_range:
+                        first, last = byte_range
+                        self.send_response(206)
+                        self.send_header('Content-Type', 'application/octet-stream')
+                        self.send_header('Content-Range', f"bytes {first}-{last}/{size}")
+                        self.send_header('Content-Length', str(last - first + 1))
+                        self.end_headers()
+                        f.seek(first)
+                        remaining = last - first + 1
+                        while remaining > 0:
+                            chunk = f.read(min(COPY_CHUNK_SIZE, remaining))
+                            if not chunk:
+                                break
+                            self.wfile.write(chunk)
+                            remaining -= len(chunk)
+                        return
+                    
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Content-Length', str(size))
+                    if not isinstance(f, ColdReader):
+                        self.send_header('Accept-Ranges', 'bytes')
+                    self.end_headers()
+                    for chunk in read_chunks(filename, f):
+                        self.wfile.write(chunk)
                 logger.info(f"Served file: {filename}")
             except Exception as e:
                 logger.error(f"Error serving file {filename}: {e}")
                 self.send_response(500)
                 self.end_headers()
 
+        elif parsed.path == '/versions':
+            # List the stored versions of a file
+            query = parse_qs(parsed.query)
+            filename = normalize_path(query.get('filename', [''])[0])
+            file_meta = metadata.get(filename) if filename else None
+
+            # A deleted file's versions can still be listed and restored
+            if not file_meta or (file_meta.get('deleted') and not file_meta.get('versions')):
+                self.send_response(404)
+                self.end_headers()
+                self.wfile.write(b"File not found")
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({
+                'filename': filename,
+                'current': None if file_meta.get('deleted') else {
+                    'hash': file_meta.get('hash', ''),
+                    'size': file_meta.get('size', 0),
+                    'modified': file_meta.get('modified', ''),
+                    'tier': file_meta.get('tier', 'hot')
+                },
+                'versions': file_meta.get('versions', [])
+            }).encode())
+
+        elif parsed.path == '/pieces':
+            # Piece hashes of a file, for peers downloading it in a swarm
+            query = parse_qs(parsed.query)
+            filename = normalize_path(query.get('filename', [''])[0])
+            file_meta = metadata.get(filename) if filename else None
+            
+            if not file_meta or not os.path.isfile(stored_path(filename)):
+                self.send_response(404)
+                self.end_headers()
+                self.wfile.write(b"File not found")
+                return
+            try:
+                piece_size = int(query.get('piece_size', [SWARM_PIECE_SIZE])[0])
+            except ValueError:
+                self.send_response(400)
+                self.end_headers()
+                return
+            piece_size = min(max(piece_size, MIN_PIECE_SIZE), MAX_PIECE_SIZE)
+            pieces = file_pieces(filename, file_meta.get('hash', ''), piece_size)
+            if pieces is None:
+                # Still hashing a large file; the peer asks again
+                self.send_response(503)
+                self.send_header('Retry-After', str(PIECE_RETRY_AFTER))
+                self.end_headers()
+                self.wfile.write(b"Piece hashes not ready, retry later")
+                return
+            
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({
+                'name': filename,
+                'hash': file_meta.get('hash', ''),
+                'size': file_meta.get('size', 0),
+                'piece_size': piece_size,
+                'pieces': pieces
+            }).encode())
+
+        elif parsed.path == '/scrub':
+            # Integrity scrubber progress and error counts
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(scrub_status).encode())
+
         elif parsed.path == '/health':
             # Health check endpoint
             health = {
                 'status': 'healthy',
-                'storage_files': len(os.listdir(STORAGE_DIR)),
+                'storage_files': sum(1 for entry in list(metadata.values()) if not entry.get('deleted')),
+                'tombstones': sum(1 for entry in list(metadata.values()) if entry.get('deleted')),
                 'nodes_configured': len(NODES),
-                'local_address': LOCAL_ADDRESS
+                'local_address': LOCAL_ADDRESS,
+                'transport_port': TRANSPORT_PORT if TRANSPORT_ENABLED else None,
+                'scrub': {key: scrub_status[key] for key in ('state', 'corrupted', 'repaired', 'errors')},
+                'read_cache': read_cache.stats(),
+                'admission': admission.stats(),
+                'load': request_load()[0],
+                'links': {peer_ids.get(node, node): speed for node, speed in list(link_speeds.items())},
+                'sync': sync_scheduler.stats(),
+                'logging': log_pipeline.stats()
             }
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
             self.end_headers()
             self.wfile.write(json.dumps(health).encode())
-        
+
         else:
             self.send_response(404)
             self.end_headers()
-
+    
     def do_POST(self):
         if self.path == '/upload':
             try:
                 length = int(self.headers['Content-Length'])
-                filename = self.headers.get('Filename', 'unnamed_file')
-                filename = sanitize_filename(filename)
+                # Relative paths are percent-encoded so any name fits in a header
+                filename = normalize_path(unquote(self.headers.get('Filename', 'unnamed_file')))
                 
-                data = self.rfile.read(length)
-                filepath = os.path.join(STORAGE_DIR, filename)
+                if not filename:
+                    self.send_response(400)
+                    self.end_headers()
+                    self.wfile.write(b"Invalid filename")
+                    return
                 
-                with open(filepath, 'wb') as f:
-                    f.write(data)
+                # Peers send the version's clock; uploads from clients are new versions
+                clock = int(self.headers['X-Clock']) if 'X-Clock' in self.headers else None
+                if clock is not None and metadata.get(filename, {}).get('clock', 0) > clock:
+                    self.reject_upload(length, 409, b"A newer version is stored")
+                    return
                 
-                # Update metadata
-                file_hash = calculate_hash(filepath)
-                metadata[filename] = {
-                    'hash': file_hash,
-                    'size': len(data),
-                    'uploaded': datetime.now().isoformat(),
-                    'modified': datetime.now().isoformat()
-                }
-                save_metadata(metadata)
+                if not admission.acquire(length):
+                    logger.warning(f"Upload of '{filename}' rejected, node busy")
+                    self.reject_upload(length, 503, b"Node busy, retry later",
+                                       {'Retry-After': str(ADMISSION_RETRY_AFTER)})
+                    return
+                try:
+                    tmp_path, file_hash, size = write_temp(read_body(self.rfile, length),
+                                                           base=file_path(filename))
+                finally:
+                    admission.release(length)
+                if not store_file(filename, tmp_path, file_hash, size, clock):
+                    self.send_response(409)
+                    self.end_headers()
+                    self.wfile.write(b"A newer version is stored")
+                    return
                 
-                logger.info(f"Stored file: {filename} ({len(data)} bytes, hash: {file_hash})")
+                logger.info(f"Stored file: {filename} ({size} bytes, hash: {file_hash})")
                 
                 self.send_response(200)
                 self.end_headers()
                 self.wfile.write(json.dumps({
                     'message': 'Stored successfully',
                     'filename': filename,
-                    'size': len(data),
+                    'size': size,
                     'hash': file_hash
                 }).encode())
             except Exception as e:
@@ -208,140 +1597,738 @@ class BackupHandler(BaseHTTPRequestHandler):
                 self.send_response(500)
                 self.end_headers()
                 self.wfile.write(f"Error: {str(e)}".encode())
-        
+
+        elif self.path == '/restore':
+            try:
+                length = int(self.headers['Content-Length'])
+                data = json.loads(self.rfile.read(length).decode())
+                filename = normalize_path(data.get('filename', ''))
+                version_id = data.get('version', '')
+
+                file_meta = metadata.get(filename, {}) if filename else {}
+                if not any(v['id'] == version_id for v in file_meta.get('versions', [])):
+                    self.send_response(404)
+                    self.end_headers()
+                    self.wfile.write(b"Version not found")
+                    return
+
+                entry = restore_version(filename, version_id)
+                logger.info(f"Restored '{filename}' to version {version_id}")
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps({
+                    'message': 'Restored successfully',
+                    'filename': filename,
+                    'hash': entry['hash'],
+                    'size': entry['size']
+                }).encode())
+            except Exception as e:
+                logger.error(f"Restore error: {e}")
+                self.send_response(500)
+                self.end_headers()
+
+        elif self.path == '/reconcile':
+            # Peel the difference between the caller's IBLT and ours
+            length = int(self.headers['Content-Length'])
+            if length > RECONCILE_MAX_CELLS * 16:
+                self.send_response(413)
+                self.end_headers()
+                return
+            try:
+                theirs = IBLT.from_bytes(self.rfile.read(length))
+            except ValueError:
+                self.send_response(400)
+                self.end_headers()
+                self.wfile.write(b"Malformed IBLT")
+                return
+            
+            diff = reconcile_against(theirs)
+            if diff is None:
+                result = {'decoded': False}
+            else:
+                result = {
+                    'decoded': True,
+                    'have': diff[0],
+                    'need': [f"{key:016x}" for key in diff[1]]
+                }
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(result).encode())
+
         elif self.path == '/delete':
             try:
                 length = int(self.headers['Content-Length'])
                 data = json.loads(self.rfile.read(length).decode())
-                filename = sanitize_filename(data.get('filename', ''))
+                filename = normalize_path(data.get('filename', ''))
+                # Peers pass on deletions with their clock
+                clock = data.get('clock')
                 
                 if not filename:
                     self.send_response(400)
                     self.end_headers()
                     return
                 
-                filepath = os.path.join(STORAGE_DIR, filename)
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                    if filename in metadata:
-                        del metadata[filename]
-                        save_metadata(metadata)
-                    logger.info(f"Deleted file: {filename}")
-                    self.send_response(200)
-                else:
-                    self.send_response(404)
+                with metadata_lock:
+                    if clock is None and (metadata.get(filename, {}).get('deleted')
+                                          or not os.path.exists(stored_path(filename))):
+                        self.send_response(404)
+                    elif delete_file(filename, clock):
+                        logger.info(f"Deleted file: {filename}")
+                        self.send_response(200)
+                    else:
+                        self.send_response(409)  # a newer version is stored
                 
                 self.end_headers()
             except Exception as e:
                 logger.error(f"Delete error: {e}")
                 self.send_response(500)
                 self.end_headers()
+        
+        elif self.path == '/sync/now':
+            # Sync one peer ({"node": X}), or all of them, without waiting for its turn
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                node = json.loads(self.rfile.read(length).decode()).get('node') if length else None
+            except ValueError:
+                self.send_response(400)
+                self.end_headers()
+                return
+            if node and node not in NODES:
+                self.send_response(404)
+                self.end_headers()
+                return
+            sync_scheduler.sync_now(None if PLANNER_ENABLED else node)
+            logger.info(f"Sync requested with {node or 'all peers'}")
+            self.send_response(202)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({'message': 'Sync scheduled', 'node': node}).encode())
         else:
             self.send_response(404)
             self.end_headers()
 
+def exchange_tombstones(node, to_push, to_pull):
+    """Apply a peer's deletions here and ours there, instead of moving the files.
+
+    A tombstone newer than the other side's file deletes it; an older one
+    gives way to the file, which sync then copies as usual. Names settled
+    here are removed from to_pull and from the returned push list.
+    """
+    pushing = set(to_push)
+    settled = set()
+    seen = []
+    for filename, (remote_hash, remote_size, remote_clock) in list(to_pull.items()):
+        if remote_hash:
+            continue
+        # The peer deleted the file
+        entry = metadata.get(filename)
+        if not entry or newer(remote_clock, remote_hash, *version_key(entry)):
+            if entry and delete_file(filename, remote_clock):
+                logger.info(f"✓ Deleted '{filename}' (deleted on {node})")
+            settled.add(filename)
+        del to_pull[filename]
+    
+    for filename in to_push:
+        entry = metadata.get(filename, {})
+        if not entry.get('deleted') or filename in settled:
+            continue
+        if filename not in to_pull:
+            seen.append(filename)  # the peer never had the file
+        else:
+            remote_hash, remote_size, remote_clock = to_pull[filename]
+            if not newer(*version_key(entry), remote_clock, remote_hash):
+                continue  # their file is newer and will be pulled
+            del to_pull[filename]
+            try:
+                resp = requests.post(f"http://{node}/delete",
+                                     json={'filename': filename, 'clock': entry['clock']}, timeout=30)
+                if resp.status_code == 200:
+                    logger.info(f"✓ Deleted '{filename}' on {node}")
+                    seen.append(filename)
+            except requests.RequestException as e:
+                logger.error(f"Error deleting '{filename}' on {node}: {e}")
+        settled.add(filename)
+    
+    # Tombstones that did not come up as differences are already on the peer
+    with metadata_lock:
+        for filename, entry in list(metadata.items()):
+            if entry.get('deleted') and filename not in pushing:
+                seen.append(filename)
+        seen = [filename for filename in seen
+                if metadata.get(filename, {}).get('deleted') and node not in metadata[filename]['seen_by']]
+        for filename in seen:
+            metadata[filename]['seen_by'].append(node)
+        if seen:
+            index.save(*seen)
+    return [filename for filename in to_push if filename not in settled]
+
+def collect_tombstones():
+    """Forget tombstones every peer has, or that are older than TOMBSTONE_MAX_DAYS"""
+    cutoff = (datetime.now() - timedelta(days=TOMBSTONE_MAX_DAYS)).isoformat()
+    with metadata_lock:
+        # A tombstone holding versions stays until retention has expired them
+        expired = [filename for filename, entry in metadata.items()
+                   if entry.get('deleted') and not entry.get('versions')
+                   and (set(NODES) <= set(entry['seen_by']) or entry['modified'] < cutoff)]
+        for filename in expired:
+            del metadata[filename]
+        if expired:
+            index.save(*expired)
+            logger.info(f"Dropped {len(expired)} tombstones all peers have seen")
+
+def resolve_conflicts(node, to_push, to_pull):
+    """Settle files whose versions differ on both sides.
+
+    The newer version by (clock, hash) travels in one direction only: a
+    name is removed from to_pull if ours wins, and from the returned push
+    list if theirs does. The losing copy is kept as a previous version when
+    the winner replaces it.
+    """
+    to_push = list(to_push)
+    conflicts = set(to_push) & set(to_pull)
+    for filename in conflicts:
+        remote_hash, remote_size, remote_clock = to_pull[filename]
+        if newer(*version_key(metadata.get(filename, {})), remote_clock, remote_hash):
+            del to_pull[filename]
+        else:
+            to_push.remove(filename)
+    if conflicts:
+        logger.info(f"Resolved {len(conflicts)} conflicting file versions with {node}")
+    return to_push
+
+def retry_delay(retry_after, attempt):
+    """Jittered backoff after a 503, starting from the peer's Retry-After"""
+    try:
+        base = float(retry_after)
+    except (TypeError, ValueError):
+        base = ADMISSION_RETRY_AFTER
+    return min(base * 2 ** attempt, PUSH_MAX_BACKOFF) * random.uniform(0.5, 1.5)
+
+def push_file(node, filename):
+    """Upload a file to a peer over HTTP, backing off while it is busy.
+
+    Returns False if the peer stayed overloaded through every retry.
+    """
+    clock = metadata.get(filename, {}).get('clock', 0)
+    for attempt in range(PUSH_RETRIES + 1):
+        with open_stored(filename) as f:
+            resp = requests.post(
+                f"http://{node}/upload",
+                data=f,
+                headers={'Filename': quote(filename), 'X-Clock': str(clock)},
+                timeout=30
+            )
+        if resp.status_code != 503:
+            break
+        if attempt == PUSH_RETRIES:
+            return False
+        delay = retry_delay(resp.headers.get('Retry-After'), attempt)
+        logger.info(f"{node} is busy, retrying '{filename}' in {delay:.1f}s")
+        time.sleep(delay)
+    
+    if resp.status_code == 200:
+        logger.info(f"✓ Pushed '{filename}' to {node}")
+    elif resp.status_code == 409:
+        logger.info(f"{node} kept a newer version of '{filename}'")
+    else:
+        logger.warning(f"Failed to push '{filename}' to {node}")
+    return True
+
+link_speeds = {}  # peer -> measured pull throughput in bytes per second
+peer_ids = {}  # peer -> the address it reports for itself, which names it in plans
+
+def record_link_speed(node, size, seconds):
+    """Fold one pull's throughput into the peer's moving average"""
+    if size >= LINK_MIN_SAMPLE and seconds > 0:
+        previous = link_speeds.get(node)
+        speed = size / seconds
+        link_speeds[node] = speed if previous is None else 0.7 * previous + 0.3 * speed
+
+def pull_file(node, filename, local_name, file_hash, clock):
+    """Download one file from a peer over HTTP and store it; False if the peer lacks that version"""
+    started = time.time()
+    resp = requests.get(
+        f"http://{node}/download",
+        params={'filename': filename, 'replica': '1'},
+        stream=True,
+        timeout=30
+    )
+    if resp.status_code != 200:
+        return False
+    tmp_path, new_hash, size = write_temp(resp.iter_content(COPY_CHUNK_SIZE), base=file_path(local_name))
+    if file_hash and new_hash != file_hash:
+        discard_temp(tmp_path)
+        logger.warning(f"Hash mismatch pulling '{filename}' from {node}")
+        return False
+    record_link_speed(node, size, time.time() - started)
+    if store_file(local_name, tmp_path, new_hash, size, clock):
+        logger.info(f"✓ Pulled '{filename}' from {node}")
+    return True
+
+def planned_sync():
+    """One sync cycle driven by the cluster-wide plan; returns the number of changes applied.
+
+    Every node plans the whole cluster from all manifests but only carries
+    out the transfers it receives, so each missing file reaches each node
+    from exactly one source. Nodes are named by the address they report for
+    themselves, so all nodes plan with the same names. A planned source that
+    is still waiting for the file itself is retried a few times; after that
+    the file is pulled from a node that already had it, since another node
+    may have planned the same pair differently.
+    """
+    manifests = {LOCAL_ADDRESS: {name: (file_hash, size, clock)
+                                 for name, file_hash, size, clock in local_listing()}}
+    reported_links = {LOCAL_ADDRESS: {peer_ids.get(node, node): speed for node, speed in list(link_speeds.items())}}
+    busy = {LOCAL_ADDRESS: request_load()[0] * PLAN_SECONDS_PER_REQUEST}
+    addresses = {}  # node id -> address to reach it at
+    for node in NODES:
+        try:
+            health = requests.get(f"http://{node}/health", timeout=5).json()
+            r = requests.get(f"http://{node}/files", params={'format': 'ndjson'}, stream=True, timeout=30)
+            if r.status_code != 200:
+                continue
+            node_id = peer_ids[node] = health.get('local_address') or node
+            addresses[node_id] = node
+            manifests[node_id] = {name: (file_hash, size, clock)
+                                  for name, file_hash, size, clock in remote_versions(r)}
+            reported_links[node_id] = health.get('links', {})
+            busy[node_id] = health.get('load', 0) * PLAN_SECONDS_PER_REQUEST
+        except (requests.RequestException, ValueError) as e:
+            logger.warning(f"Leaving {node} out of the plan: {e}")
+    
+    def link_speed(source, dest):
+        return reported_links[dest].get(source)
+    
+    versions = latest_versions(manifests)
+    # Deletions move no data; apply them and note which peers have them
+    deleted, seen = [], []
+    for filename, (file_hash, size, clock) in versions.items():
+        if not file_hash and filename in metadata:
+            # delete_file also succeeds for a deletion already applied; only
+            # count the ones that replaced the entry
+            before = metadata[filename]
+            if delete_file(filename, clock) and metadata.get(filename) is not before:
+                deleted.append(filename)
+    with metadata_lock:
+        for filename, entry in list(metadata.items()):
+            if entry.get('deleted'):
+                for node_id, node in addresses.items():
+                    if node not in entry['seen_by'] and not manifests[node_id].get(filename, ('',))[0]:
+                        entry['seen_by'].append(node)
+                        seen.append(filename)
+        if seen:
+            index.save(*seen)
+    
+    transfers = [t for t in plan(manifests, versions, link_speed, busy) if t.dest == LOCAL_ADDRESS]
+    logger.info(f"Planned {len(transfers)} transfers to this node from {len(manifests)} manifests"
+                f"{f', applied {len(deleted)} deletions' if deleted else ''}")
+    # Relays: sources that receive the file earlier in the plan. Nothing
+    # else makes them sync in time, so ask them to sync now
+    relays = {t.source for t in transfers
+              if t.source != LOCAL_ADDRESS and manifests[t.source].get(t.name, (None,))[0] != t.hash}
+    for relay in relays:
+        try:
+            requests.post(f"http://{addresses[relay]}/sync/now", timeout=5)
+        except requests.RequestException as e:
+            logger.warning(f"Could not ask relay {relay} to sync: {e}")
+    if relays:
+        logger.info(f"Asked {len(relays)} relays to sync now")
+    pending = deque((t, 0, 0) for t in transfers)
+    while pending:
+        transfer, attempts, not_before = pending.popleft()
+        time.sleep(max(0, not_before - time.time()))
+        local_name = normalize_path(transfer.name)
+        if not local_name:
+            continue
+        if attempts < PLAN_RETRIES:
+            sources = [transfer.source]
+        else:
+            sources = [node_id for node_id, manifest in manifests.items()
+                       if node_id in addresses and manifest.get(transfer.name, (None,))[0] == transfer.hash]
+        try:
+            if any(pull_file(addresses[source], transfer.name, local_name, transfer.hash, transfer.clock)
+                   for source in sources):
+                continue
+        except requests.RequestException as e:
+            logger.error(f"Error pulling '{transfer.name}': {e}")
+            continue
+        # The source is probably still receiving the file itself
+        if attempts < PLAN_RETRIES:
+            pending.append((transfer, attempts + 1, time.time() + PLAN_RETRY_DELAY))
+        else:
+            logger.warning(f"No node could provide '{transfer.name}' this cycle")
+    return len(transfers) + len(deleted)
+
+class SyncScheduler:
+    """Decides when each peer is synced next.
+
+    A peer's change rate is a moving average of the changes each sync found
+    per second since the one before. The interval aims for target_changes
+    per sync at that rate, between min_interval and max_interval, so a busy
+    peer is synced often and a quiet one less and less. A peer that cannot
+    be reached is retried after an exponential backoff. Every delay is
+    jittered so that nodes started together do not keep syncing together.
+    """
+    def __init__(self, peers):
+        now = time.time()
+        self.peers = {peer: {
+            'due': now + random.uniform(0, SYNC_JITTER * SYNC_MIN_INTERVAL),
+            'interval': SYNC_MIN_INTERVAL,
+            'rate': SYNC_TARGET_CHANGES / SYNC_MIN_INTERVAL,  # assume busy until shown otherwise
+            'failures': 0,
+            'last_sync': None,
+            'last_changes': None,
+            'last_error': None,
+            'requested': False  # sync_now() arrived since the peer was last due
+        } for peer in peers}
+        self.changed = Condition()
+    
+    def due(self):
+        """Wait until peers are due and return them, soonest first; [] after max_interval without peers"""
+        with self.changed:
+            while True:
+                now = time.time()
+                ready = sorted((state['due'], peer) for peer, state in self.peers.items() if state['due'] <= now)
+                if ready:
+                    for _, peer in ready:
+                        self.peers[peer]['requested'] = False
+                    return [peer for _, peer in ready]
+                if not self.peers:
+                    self.changed.wait(SYNC_MAX_INTERVAL)
+                    return []
+                self.changed.wait(min(state['due'] for state in self.peers.values()) - now)
+    
+    def synced(self, peer, changes):
+        with self.changed:
+            state = self.peers[peer]
+            now = time.time()
+            if state['last_sync'] is not None:
+                observed = changes / max(now - state['last_sync'], 1)
+                state['rate'] = 0.5 * state['rate'] + 0.5 * observed
+            interval = SYNC_TARGET_CHANGES / state['rate'] if state['rate'] else SYNC_MAX_INTERVAL
+            state['interval'] = min(max(interval, SYNC_MIN_INTERVAL), SYNC_MAX_INTERVAL)
+            state['due'] = now + state['interval'] * random.uniform(1 - SYNC_JITTER, 1 + SYNC_JITTER)
+            if state['requested']:
+                state['due'] = now  # asked for during this sync; run again
+            state.update(failures=0, last_sync=now, last_changes=changes, last_error=None)
+    
+    def failed(self, peer, error):
+        with self.changed:
+            state = self.peers[peer]
+            delay = min(SYNC_MIN_INTERVAL * 2 ** state['failures'], SYNC_MAX_BACKOFF)
+            state['due'] = time.time() + delay * random.uniform(0.5, 1.5)
+            if state['requested']:
+                state['due'] = time.time()
+            state['failures'] += 1
+            state['last_error'] = str(error)
+    
+    def sync_now(self, peer=None):
+        """Make one peer, or all of them, due immediately"""
+        with self.changed:
+            for name in [peer] if peer else self.peers:
+                self.peers[name].update(due=0, requested=True)
+            self.changed.notify_all()
+    
+    def stats(self):
+        with self.changed:
+            now = time.time()
+            return {peer: {
+                'next_sync_in': round(max(state['due'] - now, 0)),
+                'interval': round(state['interval']),
+                'changes_per_hour': round(state['rate'] * 3600, 2),
+                'failures': state['failures'],
+                'last_sync': datetime.fromtimestamp(state['last_sync']).isoformat() if state['last_sync'] else None,
+                'last_changes': state['last_changes'],
+                'last_error': state['last_error']
+            } for peer, state in self.peers.items()}
+
+# With the planner, the whole cluster is synced at once and scheduled as one
+PLANNED_SYNC = 'cluster'
+sync_scheduler = SyncScheduler([PLANNED_SYNC] if PLANNER_ENABLED else NODES)
+
+def sync_peer(node):
+    """Push and pull everything that differs with one peer; returns the number of differences"""
+    peer = peer_client(node)
+    differences = remote_differences(node, peer)
+    if differences:
+        to_push, to_pull = differences
+    else:
+        # Fall back to a merge-join of both name-sorted file
+        # lists; only the differences are kept in memory.
+        # The local list comes from the index, which
+        # verify_index() keeps in step with the disk.
+        if peer:
+            remote_files = peer.list_files()
+        else:
+            r = requests.get(f"http://{node}/files", params={'format': 'ndjson'},
+                             stream=True, timeout=5)
+            if r.status_code != 200:
+                logger.warning(f"Could not get file list from {node}")
+                return 0
+            remote_files = remote_versions(r)
+        
+        to_push, to_pull = [], {}
+        for name, local_version, remote_version in diff_listings(local_listing(), remote_files):
+            if local_version is not None:
+                to_push.append(name)
+            if remote_version is not None:
+                to_pull[name] = remote_version
+    changes = len(to_push) + len(to_pull)
+    to_push = exchange_tombstones(node, to_push, to_pull)
+    to_push = resolve_conflicts(node, to_push, to_pull)
+    
+    if peer:
+        replicate_over_transport(node, peer, to_push, to_pull)
+        return changes
+    
+    # Push files they don't have
+    for filename in to_push:
+        try:
+            if not push_file(node, filename):
+                logger.warning(f"{node} is overloaded, deferring the remaining "
+                               f"pushes to the next sync cycle")
+                break
+        except Exception as e:
+            logger.error(f"Error pushing '{filename}' to {node}: {e}")
+    
+    # Pull files we don't have
+    for filename, (file_hash, size, clock) in to_pull.items():
+        try:
+            local_name = normalize_path(filename)
+            if not local_name:
+                logger.warning(f"Skipping invalid path '{filename}' from {node}")
+                continue
+            if not swarm_pull(node, filename, local_name, file_hash, size, clock):
+                pull_file(node, filename, local_name, file_hash, clock)
+        except Exception as e:
+            logger.error(f"Error pulling '{filename}' from {node}: {e}")
+    return changes
+
 # Enhanced sync with bidirectional support
 def sync_loop():
-    """Automatic sync loop - both push and pull"""
+    """Automatic sync loop - both push and pull, each peer on its own schedule"""
     while True:
         try:
-            logger.info("Starting sync cycle...")
-            local_files = {}
-            
-            # Build local file list with hashes
-            for filename in os.listdir(STORAGE_DIR):
-                filepath = os.path.join(STORAGE_DIR, filename)
-                if os.path.isfile(filepath):
-                    file_meta = metadata.get(filename, {})
-                    if not file_meta.get('hash'):
-                        file_hash = calculate_hash(filepath)
-                        metadata[filename] = {
-                            'hash': file_hash,
-                            'size': os.path.getsize(filepath),
-                            'uploaded': datetime.now().isoformat(),
-                            'modified': datetime.now().isoformat()
-                        }
-                        save_metadata(metadata)
-                    local_files[filename] = metadata[filename].get('hash', '')
-            
-            # Sync with each node
-            for node in NODES:
-                try:
-                    # Get their file list
-                    r = requests.get(f"http://{node}/files", timeout=5)
-                    if r.status_code != 200:
-                        logger.warning(f"Could not get file list from {node}")
-                        continue
-                    
-                    remote_files = {f['name']: f.get('hash', '') for f in r.json()}
-                    
-                    # Push files they don't have
-                    for filename, file_hash in local_files.items():
-                        if filename not in remote_files or remote_files[filename] != file_hash:
-                            filepath = os.path.join(STORAGE_DIR, filename)
-                            try:
-                                with open(filepath, 'rb') as f:
-                                    headers = {'Filename': filename}
-                                    resp = requests.post(
-                                        f"http://{node}/upload",
-                                        data=f.read(),
-                                        headers=headers,
-                                        timeout=30
-                                    )
-                                    if resp.status_code == 200:
-                                        logger.info(f"✓ Pushed '{filename}' to {node}")
-                                    else:
-                                        logger.warning(f"Failed to push '{filename}' to {node}")
-                            except Exception as e:
-                                logger.error(f"Error pushing '{filename}' to {node}: {e}")
-                    
-                    # Pull files we don't have
-                    for filename, file_hash in remote_files.items():
-                        if filename not in local_files or local_files[filename] != file_hash:
-                            try:
-                                resp = requests.get(
-                                    f"http://{node}/download?filename={filename}",
-                                    timeout=30
-                                )
-                                if resp.status_code == 200:
-                                    filepath = os.path.join(STORAGE_DIR, filename)
-                                    with open(filepath, 'wb') as f:
-                                        f.write(resp.content)
-                                    
-                                    # Update metadata
-                                    new_hash = calculate_hash(filepath)
-                                    metadata[filename] = {
-                                        'hash': new_hash,
-                                        'size': len(resp.content),
-                                        'uploaded': datetime.now().isoformat(),
-                                        'modified': datetime.now().isoformat()
-                                    }
-                                    save_metadata(metadata)
-                                    logger.info(f"✓ Pulled '{filename}' from {node}")
-                            except Exception as e:
-                                logger.error(f"Error pulling '{filename}' from {node}: {e}")
-                
-                except requests.exceptions.Timeout:
-                    logger.warning(f"Timeout connecting to {node}")
-                except requests.exceptions.ConnectionError:
-                    logger.warning(f"Could not connect to {node}")
-                except Exception as e:
-                    logger.error(f"Sync error with {node}: {e}")
+            due = sync_scheduler.due()
+            logger.info(f"Starting sync cycle with {', '.join(due) or 'no peers'}...")
+            for node in due:
+                with log_context(peer=node, request_id=os.urandom(6).hex()):
+                    try:
+                        if node == PLANNED_SYNC:
+                            sync_scheduler.synced(node, planned_sync())
+                        else:
+                            sync_scheduler.synced(node, sync_peer(node))
+                    except requests.exceptions.Timeout as e:
+                        logger.warning(f"Timeout connecting to {node}")
+                        sync_scheduler.failed(node, e)
+                    except (requests.exceptions.ConnectionError, TransportError) as e:
+                        logger.warning(f"Could not connect to {node}")
+                        sync_scheduler.failed(node, e)
+                    except Exception as e:
+                        logger.error(f"Sync error with {node}: {e}")
+                        sync_scheduler.synced(node, 0)
             
+            prune_all_versions()
+            collect_tombstones()
             logger.info("Sync cycle completed")
         except Exception as e:
             logger.error(f"Sync loop error: {e}")
+            time.sleep(SYNC_MIN_INTERVAL)
+
+class TokenBucket:
+    """Rate limiter allowing `rate` units per second with bursts up to `capacity`"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+    
+    def consume(self, amount):
+        """Block until `amount` units are available, then take them"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            time.sleep((amount - self.tokens) / self.rate)
+
+scrub_status = {
+    'state': 'idle',
+    'passes': 0,
+    'pass_started': None,
+    'pass_finished': None,
+    'files_total': 0,
+    'files_checked': 0,
+    'bytes_checked': 0,
+    'corrupted': 0,
+    'repaired': 0,
+    'errors': 0,
+    'quarantined': [],
+    'last_error': None
+}
+
+def node_is_busy():
+    """True while the node serves more requests than background I/O allows"""
+    active, per_second = request_load()
+    return active > SCRUB_MAX_ACTIVE_REQUESTS or per_second > SCRUB_MAX_REQUESTS_PER_SEC
+
+def wait_for_quiet():
+    """Pause background I/O while the node is busy serving requests; True if it waited"""
+    waited = False
+    while node_is_busy():
+        waited = True
+        time.sleep(1)
+    return waited
+
+def repair_file(filename, expected_hash):
+    """Fetch a good copy of a file from a peer; True if repaired"""
+    for node in NODES:
+        try:
+            resp = requests.get(f"http://{node}/download",
+                                params={'filename': filename, 'replica': '1'}, stream=True, timeout=30)
+            if resp.status_code != 200:
+                continue
+            tmp_path, file_hash, size = write_temp(resp.iter_content(COPY_CHUNK_SIZE))
+            if file_hash != expected_hash:
+                discard_temp(tmp_path)
+                logger.warning(f"Peer {node} also has a bad copy of '{filename}'")
+                continue
+            store_file(filename, tmp_path, file_hash, size, metadata.get(filename, {}).get('clock', 0))
+            logger.info(f"✓ Repaired '{filename}' from {node}")
+            return True
+        except Exception as e:
+            logger.warning(f"Could not repair '{filename}' from {node}: {e}")
+    return False
+
+def scrub_file(filename, bytes_budget, iops_budget):
+    """Re-hash one file and quarantine and repair it if it no longer matches"""
+    entry = metadata.get(filename, {})
+    expected_hash = entry.get('hash')
+    filepath = stored_path(filename)
+    if not expected_hash or not os.path.isfile(filepath):
+        return
+    
+    if not entry.get('corrupt'):
+        before = os.stat(filepath)
+        hash_md5 = hashlib.md5()
+        try:
+            with open_stored(filename) as f:
+                while True:
+                    if node_is_busy():
+                        scrub_status['state'] = 'paused'
+                        wait_for_quiet()
+                        scrub_status['state'] = 'running'
+                    iops_budget.consume(1)
+                    chunk = f.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    bytes_budget.consume(len(chunk))
+                    hash_md5.update(chunk)
+                    scrub_status['bytes_checked'] += len(chunk)
+        except COLD_ERRORS:
+            if entry.get('tier') != 'cold':
+                raise
+            hash_md5 = None  # cold file no longer decompresses
+        
+        if hash_md5 and hash_md5.hexdigest() == expected_hash:
+            return
+        
+        with metadata_lock:
+            # Ignore mismatches caused by the file being replaced mid-scrub
+            try:
+                after = os.stat(filepath)
+            except FileNotFoundError:
+                return
+            if (metadata.get(filename, {}).get('hash') != expected_hash
+                    or (after.st_ino, after.st_mtime_ns) != (before.st_ino, before.st_mtime_ns)):
+                return
+            
+            quarantine_path = os.path.join(
+                QUARANTINE_DIR, f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{os.path.basename(filepath)}")
+            os.replace(filepath, quarantine_path)
+            metadata[filename]['corrupt'] = True
+            index.save(filename)
+        
+        scrub_status['corrupted'] += 1
+        scrub_status['quarantined'].append({'filename': filename, 'path': quarantine_path})
+        logger.error(f"✗ Corruption detected in '{filename}', moved to {quarantine_path}")
+    
+    if repair_file(filename, expected_hash):
+        scrub_status['repaired'] += 1
+
+def scrub_loop():
+    """Background integrity scrubber"""
+    bytes_budget = TokenBucket(SCRUB_MB_PER_SEC * 1024 * 1024, COPY_CHUNK_SIZE * 4)
+    iops_budget = TokenBucket(SCRUB_IOPS, SCRUB_IOPS)
+    
+    while True:
+        started = time.time()
+        filenames = sorted(metadata)
+        scrub_status.update({
+            'state': 'running',
+            'pass_started': datetime.now().isoformat(),
+            'files_total': len(filenames),
+            'files_checked': 0
+        })
+        
+        for filename in filenames:
+            try:
+                scrub_file(filename, bytes_budget, iops_budget)
+            except Exception as e:
+                scrub_status['errors'] += 1
+                scrub_status['last_error'] = f"{filename}: {e}"
+                logger.error(f"Scrub error on '{filename}': {e}")
+            scrub_status['files_checked'] += 1
         
-        time.sleep(SYNC_INTERVAL)
+        scrub_status.update({
+            'state': 'idle',
+            'passes': scrub_status['passes'] + 1,
+            'pass_finished': datetime.now().isoformat()
+        })
+        logger.info(f"Scrub pass completed ({scrub_status['files_checked']} files, "
+                    f"{scrub_status['corrupted']} corrupted, {scrub_status['repaired']} repaired)")
+        time.sleep(max(0, SCRUB_INTERVAL - (time.time() - started)))
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Backup node server")
+    parser.add_argument('--index', action='store_true',
+                        help="index the storage directory, then exit instead of serving")
+    parser.add_argument('--workers', type=int, default=INDEX_WORKERS,
+                        help=f"hashing processes used for indexing (default {INDEX_WORKERS})")
+    args = parser.parse_args()
+    
+    recover_in_flight()
+    migrate_flat_storage()
+    
+    if args.index:
+        verify_index(args.workers)
+        compact_index()
+        raise SystemExit(0)
+    
+    Thread(target=index_flusher, daemon=True).start()
+    Thread(target=verify_index, args=(args.workers,), daemon=True).start()
+    
     # Start sync thread
     sync_thread = Thread(target=sync_loop, daemon=True)
     sync_thread.start()
     
+    if SCRUB_ENABLED:
+        Thread(target=scrub_loop, daemon=True).start()
+    
+    if TIERING_ENABLED:
+        Thread(target=tier_loop, daemon=True).start()
+    
+    if TRANSPORT_ENABLED:
+        Thread(target=PeerServer(TRANSPORT_PORT, TransportHandler()).serve_forever, daemon=True).start()
+    
     # Start HTTP server
     try:
-        server = HTTPServer(('0.0.0.0', PORT), BackupHandler)
+        server = ThreadingHTTPServer(('0.0.0.0', PORT), BackupHandler)
         logger.info(f"🚀 Node server running at {LOCAL_ADDRESS} with bidirectional sync")
         logger.info(f"📁 Storage directory: {os.path.abspath(STORAGE_DIR)}")
         server.serve_forever()
@@ -0,0 +1,355 @@
+"""Persistent binary transport for node-to-node replication.
+
+Each pair of nodes keeps one TCP connection open and runs many requests
+over it at once as numbered streams. Every frame is a 10-byte header --
+type, flags, stream id, payload length -- followed by the payload:
+
+    LIST            -> DATA* (batches of entries), last one flagged END
+    DIFF  <iblt>    -> ACK <decoded, have entries, need keys>
+    GET   <name>    -> ACK <entry>, DATA* (file chunks), last one flagged END
+    PUT   <entry>, DATA* (file chunks), last one flagged END -> ACK <entry>
+
+A failed request is answered with ERROR <message>, and one the peer is too
+busy to take with BUSY <seconds to wait before retrying>. DATA is flow controlled
+per stream: a sender stops once it has WINDOW_SIZE bytes unacknowledged and
+resumes when the receiver returns credit in a WINDOW frame, so a slow disk
+on one side never makes the other buffer without bound.
+"""
+import socket
+import struct
+import queue
+import logging
+import itertools
+from threading import Thread, Lock, Condition
+
+HEADER = struct.Struct('!BBII')  # type, flags, stream id, payload length
+ENTRY = struct.Struct('!16sQQH')  # md5, size, version clock, name length (name follows)
+CREDIT = struct.Struct('!I')
+DIFF_REPLY = struct.Struct('!BI')  # decoded, length of the have entries
+
+# Frame types
+LIST, DIFF, GET, PUT, DATA, ACK, ERROR, WINDOW, BUSY = range(1, 10)
+REQUESTS = (LIST, DIFF, GET, PUT)
+
+END = 0x01  # last frame this side sends on the stream
+
+CHUNK_SIZE = 64 * 1024
+WINDOW_SIZE = 512 * 1024
+TIMEOUT = 60
+
+logger = logging.getLogger(__name__)
+
+class TransportError(Exception):
+    """A request failed or the connection to the peer was lost"""
+
+class PeerBusy(TransportError):
+    """The peer turned a request away because it is overloaded"""
+    def __init__(self, retry_after):
+        super().__init__(f"Peer busy, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+def encode_entry(name, file_hash, size, clock=0):
+    """Binary (name, hash, size, clock) record"""
+    name_bytes = name.encode('utf-8')
+    raw_hash = bytes.fromhex(file_hash) if file_hash else bytes(16)
+    return ENTRY.pack(raw_hash, size, clock, len(name_bytes)) + name_bytes
+
+def decode_entries(data):
+    """Yield (name, hash, size, clock) from concatenated entry records"""
+    offset = 0
+    while offset < len(data):
+        raw_hash, size, clock, name_length = ENTRY.unpack_from(data, offset)
+        offset += ENTRY.size
+        name = data[offset:offset + name_length].decode('utf-8')
+        offset += name_length
+        yield name, (raw_hash.hex() if any(raw_hash) else ''), size, clock
+
+class Stream:
+    """One request/response exchange on a connection"""
+    def __init__(self, conn, stream_id):
+        self.conn = conn
+        self.id = stream_id
+        self.frames = queue.Queue()
+        self.send_window = WINDOW_SIZE
+        self.window_changed = Condition()
+        self.unacknowledged = 0
+        self.failed = False
+
+    def send(self, frame_type, payload=b'', end=False):
+        self.conn.send_frame(frame_type, END if end else 0, self.id, payload)
+
+    def send_data(self, data, end=False):
+        """Send a DATA frame once the peer has granted window for it"""
+        with self.window_changed:
+            while self.send_window <= 0:
+                if self.failed or self.conn.closed:
+                    raise TransportError("Stream closed by peer")
+                self.window_changed.wait(1)
+            self.send_window -= len(data)
+        self.send(DATA, data, end)
+
+    def grant(self, credit):
+        with self.window_changed:
+            self.send_window += credit
+            self.window_changed.notify_all()
+
+    def fail(self):
+        with self.window_changed:
+            self.failed = True
+            self.window_changed.notify_all()
+
+    def recv(self):
+        """Next (type, flags, payload) from the peer, raising on ERROR or BUSY"""
+        try:
+            frame = self.frames.get(timeout=TIMEOUT)
+        except queue.Empty:
+            raise TransportError("Timed out waiting for peer")
+        if frame is None:
+            raise TransportError("Connection closed")
+
+        frame_type, flags, payload = frame
+        if frame_type == DATA:
+            # Hand back credit once half the window has been consumed
+            self.unacknowledged += len(payload)
+            if self.unacknowledged >= WINDOW_SIZE // 2 and not flags & END:
+                self.send(WINDOW, CREDIT.pack(self.unacknowledged))
+                self.unacknowledged = 0
+        elif frame_type == ERROR:
+            self.close()
+            raise TransportError(payload.decode('utf-8', 'replace'))
+        elif frame_type == BUSY:
+            self.close()
+            raise PeerBusy(CREDIT.unpack(payload)[0])
+        return frame
+
+    def iter_data(self):
+        """Yield DATA payloads until the peer ends the stream"""
+        while True:
+            frame_type, flags, payload = self.recv()
+            if payload:
+                yield payload
+            if flags & END:
+                self.close()
+                return
+
+    def close(self):
+        self.conn.streams.pop(self.id, None)
+
+class Connection:
+    """Framed, multiplexed TCP connection"""
+    def __init__(self, sock, first_id, on_request=None):
+        self.sock = sock
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = Lock()
+        self.streams = {}
+        self.ids = itertools.count(first_id, 2)  # clients odd, servers even
+        self.on_request = on_request
+        self.closed = False
+        Thread(target=self._read_loop, daemon=True).start()
+
+    def send_frame(self, frame_type, flags, stream_id, payload=b''):
+        if self.closed:
+            raise TransportError("Connection closed")
+        try:
+            with self.send_lock:
+                self.sock.sendall(HEADER.pack(frame_type, flags, stream_id, len(payload)) + payload)
+        except OSError as e:
+            self.close()
+            raise TransportError(str(e))
+
+    def open_stream(self, frame_type, payload=b'', end=False):
+        stream = Stream(self, next(self.ids))
+        self.streams[stream.id] = stream
+        stream.send(frame_type, payload, end)
+        return stream
+
+    def _recv_exact(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise TransportError("Connection closed")
+            data += chunk
+        return bytes(data)
+
+    def _read_loop(self):
+        try:
+            while True:
+                frame_type, flags, stream_id, length = HEADER.unpack(self._recv_exact(HEADER.size))
+                payload = self._recv_exact(length) if length else b''
+                stream = self.streams.get(stream_id)
+
+                if frame_type == WINDOW:
+                    if stream:
+                        stream.grant(CREDIT.unpack(payload)[0])
+                elif stream:
+                    if frame_type in (ERROR, BUSY):
+                        stream.fail()
+                    stream.frames.put((frame_type, flags, payload))
+                elif self.on_request and frame_type in REQUESTS:
+                    stream = self.streams[stream_id] = Stream(self, stream_id)
+                    Thread(target=self.on_request, args=(stream, frame_type, payload), daemon=True).start()
+                # Anything else belongs to a stream that already finished
+        except (OSError, TransportError, struct.error):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        for stream in list(self.streams.values()):
+            stream.fail()
+            stream.frames.put(None)
+
+class PeerClient:
+    """Client side of the transport; safe to share between threads"""
+    def __init__(self, host, port):
+        sock = socket.create_connection((host, port), timeout=TIMEOUT)
+        sock.settimeout(None)
+        self.conn = Connection(sock, first_id=1)
+
+    @property
+    def closed(self):
+        return self.conn.closed
+
+    def close(self):
+        self.conn.close()
+
+    def list_files(self):
+        """Yield the peer's (name, hash, size, clock) entries"""
+        stream = self.conn.open_stream(LIST, end=True)
+        for payload in stream.iter_data():
+            yield from decode_entries(payload)
+
+    def reconcile(self, table_bytes):
+        """Send an IBLT; returns ([(name, hash, size, clock)] the peer has, [keys] it needs) or None"""
+        stream = self.conn.open_stream(DIFF, table_bytes, end=True)
+        frame_type, flags, payload = stream.recv()
+        stream.close()
+        decoded, have_length = DIFF_REPLY.unpack_from(payload)
+        if not decoded:
+            return None
+        have_end = DIFF_REPLY.size + have_length
+        have = list(decode_entries(payload[DIFF_REPLY.size:have_end]))
+        need = [key for (key,) in struct.iter_unpack('!Q', payload[have_end:])]
+        return have, need
+
+    def start_get(self, name):
+        return self.conn.open_stream(GET, name.encode('utf-8'), end=True)
+
+    def finish_get(self, stream):
+        """Wait for a GET reply: (hash, size, iterator over the file's chunks)"""
+        frame_type, flags, payload = stream.recv()
+        name, file_hash, size, clock = next(decode_entries(payload))
+        if flags & END:
+            stream.close()
+            return file_hash, size, iter(())
+        return file_hash, size, stream.iter_data()
+
+    def start_put(self, name, fileobj, file_hash, size, clock):
+        """Send a file without waiting for the peer to store it"""
+        stream = self.conn.open_stream(PUT, encode_entry(name, file_hash, size, clock))
+        chunk = fileobj.read(CHUNK_SIZE)
+        while True:
+            following = fileobj.read(CHUNK_SIZE) if chunk else b''
+            try:
+                stream.send_data(chunk, end=not following)
+            except TransportError:
+                return stream  # the peer answered early; finish_put() reports why
+            if not following:
+                return stream
+            chunk = following
+
+    def finish_put(self, stream):
+        """Wait for the peer to store a file: (hash, size) of the version it keeps"""
+        frame_type, flags, payload = stream.recv()
+        stream.close()
+        name, file_hash, size, clock = next(decode_entries(payload))
+        return file_hash, size
+
+class PeerServer:
+    """Serves transport requests using a handler object.
+
+    The handler provides list_files() yielding (name, hash, size, clock),
+    reconcile(table_bytes) returning ([(name, hash, size, clock)], [keys]) or None,
+    open_file(name) returning (file object, hash, size) or None, and
+    store_file(name, hash, size, clock, chunks) returning (hash, size).
+    A handler raises PeerBusy to turn a request away until later.
+    """
+    def __init__(self, port, handler):
+        self.port = port
+        self.handler = handler
+
+    def serve_forever(self):
+        listener = socket.create_server(('', self.port))
+        logger.info(f"Peer transport listening on port {self.port}")
+        while True:
+            sock, address = listener.accept()
+            Connection(sock, first_id=2, on_request=self._dispatch)
+
+    def _dispatch(self, stream, frame_type, payload):
+        try:
+            if frame_type == LIST:
+                batch = []
+                batch_size = 0
+                for name, file_hash, size, clock in self.handler.list_files():
+                    entry = encode_entry(name, file_hash, size, clock)
+                    batch.append(entry)
+                    batch_size += len(entry)
+                    if batch_size >= CHUNK_SIZE:
+                        stream.send_data(b''.join(batch))
+                        batch, batch_size = [], 0
+                stream.send_data(b''.join(batch), end=True)
+
+            elif frame_type == DIFF:
+                result = self.handler.reconcile(payload)
+                if result is None:
+                    stream.send(ACK, DIFF_REPLY.pack(0, 0), end=True)
+                else:
+                    have, need = result
+                    have_bytes = b''.join(encode_entry(*entry) for entry in have)
+                    stream.send(ACK, DIFF_REPLY.pack(1, len(have_bytes)) + have_bytes +
+                                b''.join(struct.pack('!Q', key) for key in need), end=True)
+
+            elif frame_type == GET:
+                name = payload.decode('utf-8')
+                opened = self.handler.open_file(name)
+                if opened is None:
+                    stream.send(ERROR, b"File not found", end=True)
+                    return
+                fileobj, file_hash, size = opened
+                with fileobj:
+                    stream.send(ACK, encode_entry(name, file_hash, size))
+                    chunk = fileobj.read(CHUNK_SIZE)
+                    while True:
+                        following = fileobj.read(CHUNK_SIZE) if chunk else b''
+                        stream.send_data(chunk, end=not following)
+                        if not following:
+                            break
+                        chunk = following
+
+            elif frame_type == PUT:
+                name, file_hash, size, clock = next(decode_entries(payload))
+                file_hash, size = self.handler.store_file(name, file_hash, size, clock, stream.iter_data())
+                stream.send(ACK, encode_entry(name, file_hash, size), end=True)
+        except PeerBusy as e:
+            try:
+                stream.send(BUSY, CREDIT.pack(int(e.retry_after)), end=True)
+            except TransportError:
+                pass
+        except TransportError:
+            pass  # connection went away
+        except Exception as e:
+            logger.error(f"Peer transport request failed: {e}")
+            try:
+                stream.send(ERROR, str(e).encode('utf-8'), end=True)
+            except TransportError:
+                pass
+        finally:
+            stream.close()
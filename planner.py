@@ -0,0 +1,81 @@
+"""Cluster-wide replication planning.
+
+Given every node's manifest, the planner works out which version of each
+file should win, which nodes are missing it, and for each missing
+(file, node) pair exactly one node to copy it from. Nodes that receive a
+file early in the plan become sources for later transfers, so a new file
+spreads through the cluster as a tree instead of every node fetching it
+from the one that has it.
+
+Transfers are scheduled greedily, largest files first: each one goes to
+the (source, destination) pair that would finish it soonest, given link
+speeds and the time each node's upload and download capacity is already
+booked.
+"""
+from collections import namedtuple
+
+DEFAULT_LINK_SPEED = 50 * 1024 * 1024  # bytes per second, for links never measured
+TRANSFER_OVERHEAD = 0.05  # seconds per transfer, so small files prefer fewer hops
+
+Transfer = namedtuple('Transfer', 'name hash size clock source dest start finish')
+
+def latest_versions(manifests):
+    """{name: (hash, size, clock)} of the winning version of every file.
+
+    manifests maps node -> {name: (hash, size, clock)}. Versions are
+    ordered by (clock, hash); an empty hash is a deletion.
+    """
+    versions = {}
+    for manifest in manifests.values():
+        for name, (file_hash, size, clock) in manifest.items():
+            current = versions.get(name)
+            if current is None or (clock, file_hash) > (current[2], current[0]):
+                versions[name] = (file_hash, size, clock)
+    return versions
+
+def plan(manifests, versions=None, link_speed=None, busy=None):
+    """Transfers that bring every node up to date, sorted by planned start.
+
+    link_speed(source, dest) gives bytes per second, or None if unknown;
+    busy maps node -> seconds of work it already has queued. Deletions are
+    not planned: they need no data.
+    """
+    if versions is None:
+        versions = latest_versions(manifests)
+    nodes = sorted(manifests)
+    upload_free = {node: (busy or {}).get(node, 0.0) for node in nodes}
+    download_free = dict(upload_free)
+
+    def duration(size, source, dest):
+        speed = link_speed(source, dest) if link_speed else None
+        return size / (speed or DEFAULT_LINK_SPEED) + TRANSFER_OVERHEAD
+
+    transfers = []
+    for name, (file_hash, size, clock) in sorted(versions.items(), key=lambda item: (-item[1][1], item[0])):
+        if not file_hash:
+            continue
+        ready = {}  # node -> time it holds this version
+        missing = []
+        for node in nodes:
+            if manifests[node].get(name, (None,))[0] == file_hash:
+                ready[node] = 0.0
+            else:
+                missing.append(node)
+        if not ready:
+            continue
+
+        while missing:
+            best = None
+            for dest in missing:
+                for source, available in ready.items():
+                    start = max(available, upload_free[source], download_free[dest])
+                    finish = start + duration(size, source, dest)
+                    if best is None or finish < best[0]:
+                        best = (finish, start, source, dest)
+            finish, start, source, dest = best
+            transfers.append(Transfer(name, file_hash, size, clock, source, dest, start, finish))
+            upload_free[source] = download_free[dest] = ready[dest] = finish
+            missing.remove(dest)
+
+    transfers.sort(key=lambda transfer: (transfer.start, transfer.name, transfer.dest))
+    return transfers
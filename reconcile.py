@@ -0,0 +1,105 @@
+"""Set reconciliation between nodes with invertible Bloom lookup tables.
+
+Each node summarizes its files as a set of 64-bit keys, one per
+(name, hash) pair, and folds them into an IBLT: a small table of cells
+holding a count, the XOR of the keys and the XOR of a check value. The
+table size depends only on how many pairs differ, not on how many files
+there are. Subtracting two tables cancels every pair both nodes share, and
+peeling the remaining "pure" cells recovers exactly the pairs that only
+one side has.
+"""
+import struct
+import hashlib
+
+HASH_COUNT = 3  # cells each key is added to, one per sub-table
+CELL = struct.Struct('<iQI')  # count, key sum, check sum
+MASK64 = (1 << 64) - 1
+CHECK_SALT = 0x5bd1e9955bd1e995
+
+def _mix(x):
+    """SplitMix64 finalizer, used to derive cell indices and checks from a key"""
+    x = (x + 0x9e3779b97f4a7c15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & MASK64
+    return x ^ (x >> 31)
+
+def _check(key):
+    return _mix(key ^ CHECK_SALT) & 0xffffffff
+
+def pair_key(name, file_hash):
+    """64-bit key for a (name, hash) pair"""
+    digest = hashlib.sha1(f"{name}\0{file_hash}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+class IBLT:
+    """Invertible Bloom lookup table over 64-bit keys"""
+    def __init__(self, size):
+        self.size = max(HASH_COUNT, size - size % HASH_COUNT)
+        self.counts = [0] * self.size
+        self.keys = [0] * self.size
+        self.checks = [0] * self.size
+
+    def _cells(self, key):
+        sub = self.size // HASH_COUNT
+        return [i * sub + _mix(key + i) % sub for i in range(HASH_COUNT)]
+
+    def _toggle(self, key, check, delta):
+        for cell in self._cells(key):
+            self.counts[cell] += delta
+            self.keys[cell] ^= key
+            self.checks[cell] ^= check
+
+    def add(self, key):
+        self._toggle(key, _check(key), 1)
+
+    def subtract(self, other):
+        """Table of the keys in self minus the keys in other"""
+        if other.size != self.size:
+            raise ValueError("IBLT sizes differ")
+        result = IBLT(self.size)
+        result.counts = [a - b for a, b in zip(self.counts, other.counts)]
+        result.keys = [a ^ b for a, b in zip(self.keys, other.keys)]
+        result.checks = [a ^ b for a, b in zip(self.checks, other.checks)]
+        return result
+
+    def decode(self):
+        """Peel a difference table into (keys only in self, keys only in other).
+
+        Returns None if the table is too small for the difference.
+        """
+        only_self, only_other = set(), set()
+        pending = list(range(self.size))
+        while pending:
+            cell = pending.pop()
+            count, key = self.counts[cell], self.keys[cell]
+            if count not in (1, -1) or self.checks[cell] != _check(key):
+                continue
+            (only_self if count == 1 else only_other).add(key)
+            self._toggle(key, _check(key), -count)
+            pending.extend(self._cells(key))
+
+        if any(self.counts) or any(self.keys) or any(self.checks):
+            return None
+        return only_self, only_other
+
+    def to_bytes(self):
+        return b''.join(CELL.pack(count, key, check)
+                        for count, key, check in zip(self.counts, self.keys, self.checks))
+
+    @classmethod
+    def from_bytes(cls, data):
+        if not data or len(data) % CELL.size or (len(data) // CELL.size) % HASH_COUNT:
+            raise ValueError("Malformed IBLT")
+        table = cls(len(data) // CELL.size)
+        for i, (count, key, check) in enumerate(CELL.iter_unpack(data)):
+            table.counts[i] = count
+            table.keys[i] = key
+            table.checks[i] = check
+        return table
+
+def build_table(keys, size):
+    """IBLT of the given size holding every key"""
+    table = IBLT(size)
+    for key in keys:
+        table.add(key)
+    return table
@@ -0,0 +1,481 @@
+"""Storage engine shared by node_v2, web_gui and gui_v2.
+
+The index of stored files is kept in memory by every process that uses
+it, and persisted as a binary snapshot (index.bin) plus an append-only
+journal of changes since (metadata.journal). metadata.json is rewritten
+with each snapshot for tools that read it directly.
+
+Processes coordinate through an exclusive lock on metadata.lock, held only
+while they read or append journal records or write a snapshot. A process
+catches up with the records others have appended before it appends its
+own, so every process replays the journal in the same order. refresh()
+applies new records incrementally; a full reload only happens after
+another process has written a snapshot. None of the front ends rescan or
+rehash what another has already indexed.
+
+StorageEngine is the front ends' view: files in both tiers, opening cold
+files, and adding and deleting files the way the node does, with clocks
+and tombstones so sync carries the change to peers. listing_records() and
+remote_listing() read a peer's /files listing for all three.
+"""
+import os
+import gzip
+import json
+import time
+import pickle
+import shutil
+import requests
+from contextlib import contextmanager
+from datetime import datetime
+from threading import RLock
+from storage_layout import physical_path, location_for, hash_file
+from hlc import HybridClock, newer, wall_clock
+
+try:
+    import fcntl
+except ImportError:  # Windows: processes are not coordinated
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:  # cold files fall back to gzip
+    zstandard = None
+
+STORAGE_DIR = 'storage'
+VERSIONS_DIR = 'versions'
+COLD_DIR = 'cold'
+METADATA_FILE = 'metadata.json'
+INDEX_FILE = 'index.bin'  # binary snapshot of metadata, loaded at startup
+JOURNAL_FILE = 'metadata.journal'  # changes and in-flight writes since the last snapshot
+LOCK_FILE = 'metadata.lock'  # serializes journal and snapshot access between processes
+COMPACT_RECORDS = 10000  # front ends snapshot once the journal has this many records
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def write_atomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def file_entry(file_hash, size, location, mtime_ns, clock):
+    """Index entry of a file just stored at location"""
+    now = datetime.now().isoformat()
+    return {
+        'hash': file_hash,
+        'size': size,
+        'mtime_ns': mtime_ns,
+        'uploaded': now,
+        'modified': now,
+        'location': location,
+        'clock': clock
+    }
+
+def listed_state(entry):
+    """The parts of an entry that peers see in listings"""
+    return (entry.get('hash'), entry.get('clock'), bool(entry.get('deleted')),
+            bool(entry.get('corrupt')), bool(entry.get('location')))
+
+def tombstone(clock):
+    """Index entry left by a deletion, so that sync deletes the file on peers"""
+    return {
+        'deleted': True,
+        'hash': '',
+        'size': 0,
+        'modified': datetime.now().isoformat(),
+        'clock': clock,
+        'seen_by': []
+    }
+
+class StorageIndex:
+    """In-memory index of stored files, kept in step with the on-disk journal.
+
+    `entries` and `in_flight` are updated in place, so references to them
+    stay valid across refreshes. `version` is bumped on every change, by
+    this process or another, to invalidate derived data. `listing_version`
+    is bumped only when a file is added or removed or its listed_state()
+    changes, for data derived from listings alone.
+    """
+    def __init__(self, metadata_file=METADATA_FILE, index_file=INDEX_FILE,
+                 journal_file=JOURNAL_FILE, lock_file=LOCK_FILE):
+        self.metadata_file = metadata_file
+        self.index_file = index_file
+        self.journal_file = journal_file
+        self.entries = {}
+        self.in_flight = {}  # temp file name -> journal record of writes not finished yet
+        self.lock = RLock()
+        self.version = 0
+        self.listing_version = 0
+        self._listed = {}  # name -> listed_state() as of the last change applied
+        self.records = 0  # records in the current journal
+        self.last_compaction = time.time()
+        self._lock_file = open(lock_file, 'a')
+        self._depth = 0
+        self._journal = None
+        self._journal_ino = None
+        self._offset = 0
+        self.load()
+
+    @contextmanager
+    def locked(self):
+        """Hold the index exclusively, against threads and other processes"""
+        with self.lock:
+            if self._depth == 0 and fcntl:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0 and fcntl:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _note_listed(self, name, entry):
+        state = listed_state(entry) if entry is not None else None
+        if self._listed.get(name) != state:
+            if state is None:
+                del self._listed[name]
+            else:
+                self._listed[name] = state
+            self.listing_version += 1
+
+    def _apply(self, record):
+        if 'set' in record:
+            self.entries[record['set']] = record['entry']
+            self._note_listed(record['set'], record['entry'])
+        elif 'del' in record:
+            self.entries.pop(record['del'], None)
+            self._note_listed(record['del'], None)
+        elif 'end' in record:
+            self.in_flight.pop(record['end'], None)
+        else:
+            op_id = record.get('commit') or record['begin']
+            self.in_flight.setdefault(op_id, {}).update(record)
+
+    def _read_journal(self):
+        """Apply the complete records appended since the last read"""
+        with open(self.journal_file, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1  # a torn last line is left for later
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # torn write at the moment of a crash
+            self._apply(record)
+            self.records += 1
+        self._offset += end
+        if end:
+            self.version += 1
+
+    def load(self):
+        """Load the newest snapshot, then replay the journal on top of it"""
+        with self.locked():
+            entries = {}
+            index_mtime = os.path.getmtime(self.index_file) if os.path.exists(self.index_file) else None
+            if os.path.exists(self.metadata_file) and (
+                    index_mtime is None or os.path.getmtime(self.metadata_file) > index_mtime):
+                # No snapshot yet, or metadata.json was edited after it
+                with open(self.metadata_file, 'r') as f:
+                    entries = json.load(f)
+            elif index_mtime is not None:
+                with open(self.index_file, 'rb') as f:
+                    entries = pickle.load(f)
+
+            # Keep unchanged entries as the same objects, so code holding
+            # one does not take it for replaced
+            for name in set(self.entries) - set(entries):
+                del self.entries[name]
+                self._note_listed(name, None)
+            for name, entry in entries.items():
+                if self.entries.get(name) != entry:
+                    self.entries[name] = entry
+                self._note_listed(name, entry)
+            self.in_flight.clear()
+
+            if self._journal:
+                self._journal.close()
+            self._journal = open(self.journal_file, 'ab')
+            self._journal_ino = os.fstat(self._journal.fileno()).st_ino
+            self._offset = 0
+            self.records = 0
+            self._read_journal()
+            self.version += 1
+
+    def refresh(self):
+        """Apply changes made by other processes; True if there were any"""
+        with self.locked():
+            version = self.version
+            try:
+                st = os.stat(self.journal_file)
+            except FileNotFoundError:
+                st = None
+            if st is None or st.st_ino != self._journal_ino:
+                self.load()  # another process wrote a snapshot
+            elif st.st_size > self._offset:
+                self._read_journal()
+            return self.version != version
+
+    def append(self, *records):
+        """Journal records and apply them to the in-memory index"""
+        with self.locked():
+            self.refresh()
+            data = ''.join(json.dumps(record) + '\n' for record in records).encode()
+            self._journal.write(data)
+            self._journal.flush()
+            self._offset += len(data)
+            self.records += len(records)
+            for record in records:
+                self._apply(record)
+            self.version += 1
+
+    def save(self, *names):
+        """Journal the named entries (removed ones as deletions); snapshot everything if none are named"""
+        with self.locked():
+            if not names:
+                self.compact()
+                return
+            self.append(*({'set': name, 'entry': self.entries[name]} if name in self.entries else {'del': name}
+                          for name in names))
+
+    def compact(self):
+        """Write metadata.json and the binary snapshot, then start a new journal"""
+        with self.locked():
+            self.refresh()
+            # metadata.json first: the snapshot must end up the newer of the two
+            write_atomic(self.metadata_file, json.dumps(self.entries, indent=2).encode())
+            write_atomic(self.index_file, pickle.dumps(self.entries, pickle.HIGHEST_PROTOCOL))
+            # Writes still in flight carry over to the new journal
+            data = ''.join(json.dumps(record) + '\n' for record in self.in_flight.values()).encode()
+            write_atomic(self.journal_file, data)
+            self._journal.close()
+            self._journal = open(self.journal_file, 'ab')
+            self._journal_ino = os.fstat(self._journal.fileno()).st_ino
+            self._offset = len(data)
+            self.records = len(self.in_flight)
+            self.last_compaction = time.time()
+
+class ColdFile:
+    """Readable stream over the decompressed content of a cold file"""
+    def __init__(self, cold_dir, entry):
+        self.entry = entry
+        self.raw = open(physical_path(cold_dir, entry['cold_location']), 'rb')
+        if entry.get('codec') == 'zstd':
+            if zstandard is None:
+                self.raw.close()
+                raise IOError("zstandard is needed to read this cold file")
+            self.stream = zstandard.ZstdDecompressor().stream_reader(self.raw)
+        else:
+            self.stream = gzip.GzipFile(fileobj=self.raw, mode='rb')
+
+    def __len__(self):
+        return self.entry.get('size', 0)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def close(self):
+        self.stream.close()
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class StorageEngine:
+    """Stored files as the front ends see them, in both tiers"""
+    def __init__(self, storage_dir=STORAGE_DIR, cold_dir=COLD_DIR, versions_dir=VERSIONS_DIR):
+        self.storage_dir = storage_dir
+        self.cold_dir = cold_dir
+        self.versions_dir = versions_dir
+        os.makedirs(storage_dir, exist_ok=True)
+        self.index = StorageIndex()
+        self.clock = HybridClock()
+
+    def refresh(self):
+        return self.index.refresh()
+
+    def entry(self, name):
+        """Index entry of a live file, or None"""
+        self.index.refresh()
+        entry = self.index.entries.get(name)
+        if entry and not entry.get('deleted') and not entry.get('corrupt'):
+            return entry
+        if not entry and '/' not in name and os.path.isfile(os.path.join(self.storage_dir, name)):
+            return {}  # legacy flat file the node has not moved into a shard yet
+        return None
+
+    def path(self, name):
+        """Filesystem path of a live hot file, or None (missing or cold)"""
+        entry = self.entry(name)
+        if entry is None or entry.get('tier') == 'cold':
+            return None
+        if entry.get('location'):
+            path = physical_path(self.storage_dir, entry['location'])
+        else:
+            path = os.path.join(self.storage_dir, name)
+        return path if os.path.isfile(path) else None
+
+    def open(self, name):
+        """Readable stream over a live file's content in either tier, or None"""
+        entry = self.entry(name)
+        if entry is not None and entry.get('tier') == 'cold':
+            return ColdFile(self.cold_dir, entry)
+        path = self.path(name)
+        return open(path, 'rb') if path else None
+
+    def files(self):
+        """Listing entry (name, size, modified, hash, clock, tier) of every live file"""
+        self.index.refresh()
+        files = []
+        with self.index.lock:
+            entries = list(self.index.entries.items())
+        for name, entry in entries:
+            if entry.get('deleted') or entry.get('corrupt'):
+                continue
+            if entry.get('tier') == 'cold':
+                files.append({'name': name, 'size': entry.get('size', 0), 'modified': entry.get('modified', ''),
+                              'hash': entry.get('hash', ''), 'clock': entry.get('clock', 0), 'tier': 'cold'})
+                continue
+            if not entry.get('location'):
+                continue
+            try:
+                st = os.stat(physical_path(self.storage_dir, entry['location']))
+            except FileNotFoundError:
+                continue
+            # Trust the indexed hash only while the file is unchanged
+            unchanged = entry.get('size') == st.st_size and entry.get('mtime_ns', st.st_mtime_ns) == st.st_mtime_ns
+            # A file edited in place is dated by its mtime until the node rehashes it
+            files.append({'name': name, 'size': st.st_size,
+                          'modified': datetime.fromtimestamp(st.st_mtime).isoformat(),
+                          'hash': entry.get('hash', '') if unchanged else '',
+                          'clock': entry.get('clock', 0) if unchanged else wall_clock(st.st_mtime),
+                          'tier': 'hot'})
+
+        # Legacy flat files that have not been moved into shards yet
+        with os.scandir(self.storage_dir) as legacy:
+            for item in legacy:
+                if item.is_file() and not self.index.entries.get(item.name, {}).get('location'):
+                    st = item.stat()
+                    files.append({'name': item.name, 'size': st.st_size,
+                                  'modified': datetime.fromtimestamp(st.st_mtime).isoformat(),
+                                  'hash': '', 'clock': wall_clock(st.st_mtime), 'tier': 'hot'})
+        return files
+
+    def missing_on(self, remote):
+        """Live files a peer should be sent, given its listing {name: record}.
+
+        The listing must include the peer's tombstones: a file the peer has
+        deleted is only sent again if our version is newer than the deletion.
+        """
+        missing = []
+        for f in self.files():
+            record = remote.get(f['name'])
+            if record is None or (record.get('deleted')
+                                  and newer(f['clock'], f['hash'], record.get('clock', 0), '')):
+                missing.append(f)
+        return missing
+
+    def register(self, name, location, file_hash=None, size=None):
+        """Index a file already written to its shard location, replacing any previous version"""
+        path = physical_path(self.storage_dir, location)
+        if file_hash is None:
+            file_hash, size, mtime_ns = hash_file(path)
+        else:
+            mtime_ns = os.stat(path).st_mtime_ns
+        with self.index.locked():
+            self.index.refresh()
+            old_entry = self.index.entries.get(name, {})
+            self.clock.update(old_entry.get('clock', 0))
+            entry = file_entry(file_hash, size, location, mtime_ns, self.clock.now())
+            if old_entry.get('versions'):
+                entry['versions'] = old_entry['versions']
+            legacy = os.path.join(self.storage_dir, name)
+            if '/' not in name and os.path.isfile(legacy):
+                os.remove(legacy)  # replaced a file from the old flat layout
+            if old_entry.get('tier') == 'cold':
+                self._remove(physical_path(self.cold_dir, old_entry['cold_location']))
+            self.index.entries[name] = entry
+            self.index.save(name)
+            self._maybe_compact()
+        return entry
+
+    def delete(self, name):
+        """Delete a live file, leaving a tombstone; False if there is no such file.
+
+        The deleted content is kept as a version; the node's retention
+        policy expires it with the file's other versions.
+        """
+        with self.index.locked():
+            entry = self.entry(name)
+            if entry is None:
+                return False
+            versions = list(entry.get('versions', []))
+            if entry.get('tier') == 'cold':
+                cold_path = physical_path(self.cold_dir, entry['cold_location'])
+                versions.append(self._keep_version(name, entry, None))
+                self._remove(cold_path)
+            else:
+                path = self.path(name)
+                if path:
+                    versions.append(self._keep_version(name, entry, path))
+                    self._remove(path)
+            self.clock.update(entry.get('clock', 0))
+            self.index.entries[name] = tombstone(self.clock.now())
+            if versions:
+                self.index.entries[name]['versions'] = versions
+            self.index.save(name)
+            self._maybe_compact()
+        return True
+
+    def _keep_version(self, name, entry, path):
+        """Keep a file's current content under versions/; returns the version record.
+
+        path is the hot file, or None to decompress the cold copy.
+        """
+        version_id = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+        target = os.path.join(physical_path(self.versions_dir, entry.get('location') or location_for(name)),
+                              version_id)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if path is None:
+            with ColdFile(self.cold_dir, entry) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+        else:
+            try:
+                os.link(path, target)  # the live file is removed next
+            except OSError:
+                shutil.copy2(path, target)
+        file_hash, size = entry.get('hash'), entry.get('size')
+        if not file_hash:
+            file_hash, size, _ = hash_file(target)  # legacy flat file, never indexed
+        return {'id': version_id, 'hash': file_hash, 'size': size, 'created': datetime.now().isoformat()}
+
+    def _remove(self, path):
+        if path:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _maybe_compact(self):
+        if self.index.records >= COMPACT_RECORDS:
+            self.index.compact()
+
+def listing_records(resp):
+    """Yield the records of a node's /files response as dicts, sorted by name"""
+    if resp.headers.get('Content-Type', '').startswith('application/x-ndjson'):
+        for line in resp.iter_lines():
+            if line:
+                yield json.loads(line)
+    else:
+        # Nodes that do not stream list live files only, the oldest as bare names
+        records = ({'name': f} if isinstance(f, str) else f for f in resp.json())
+        yield from sorted(records, key=lambda f: f['name'])
+
+def remote_listing(node):
+    """{name: record} of a node's files, tombstones included"""
+    resp = requests.get(f"http://{node}/files", params={'format': 'ndjson'}, stream=True, timeout=5)
+    resp.raise_for_status()
+    return {f['name']: f for f in listing_records(resp)}
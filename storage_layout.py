@@ -0,0 +1,66 @@
+"""Storage layout shared by node_v2, web_gui and gui_v2.
+
+Files are addressed by a relative path such as ``photos/2024/beach.jpg``.
+On disk each file lives in a sharded directory under the storage root,
+``storage/ab/cd/abcd...``, named after the SHA-1 of its path, so no
+directory grows past a few thousand entries and different directories
+can hold files with the same name. Each file's metadata entry records its
+``location``; that metadata is the path-to-location index.
+"""
+import os
+import hashlib
+
+def normalize_path(path):
+    """Turn a client-supplied path into a safe relative POSIX path (None if invalid)"""
+    if not path:
+        return None
+
+    parts = []
+    for part in path.replace('\\', '/').split('/'):
+        if part in ('', '.'):
+            continue
+        if part == '..' or '\0' in part:
+            return None  # path traversal
+        parts.append(part)
+
+    return '/'.join(parts) or None
+
+def location_for(path):
+    """Sharded location of a logical path, relative to the storage root"""
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    return f"{digest[:2]}/{digest[2:4]}/{digest}"
+
+def physical_path(storage_dir, location):
+    """Absolute-or-relative filesystem path of a location"""
+    return os.path.join(storage_dir, *location.split('/'))
+
+def resolve(storage_dir, metadata, path):
+    """Filesystem path of a logical path, preferring the index entry"""
+    entry = metadata.get(path) or {}
+    if entry.get('location'):
+        return physical_path(storage_dir, entry['location'])
+
+    # Files dropped into the storage root before sharding existed
+    legacy = os.path.join(storage_dir, path)
+    if '/' not in path and os.path.isfile(legacy):
+        return legacy
+    return physical_path(storage_dir, location_for(path))
+
+def prepare_location(storage_dir, path):
+    """Create the shard directories for a path and return (location, filesystem path)"""
+    location = location_for(path)
+    filepath = physical_path(storage_dir, location)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    return location, filepath
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """Return (md5, size, mtime_ns) of a file, or None if it disappeared"""
+    try:
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            hash_md5 = hashlib.md5()
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                hash_md5.update(chunk)
+    except FileNotFoundError:
+        return None
+    return hash_md5.hexdigest(), st.st_size, st.st_mtime_ns
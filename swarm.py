@@ -0,0 +1,159 @@
+"""Swarm downloads: fetch one file's pieces from several peers at once.
+
+The file is split into fixed-size pieces, and one peer's /pieces listing
+gives the MD5 of each. Every peer gets a few worker connections that take
+the next missing piece from a shared queue, fetch it with an HTTP Range
+request from /download, check it against the listing and write it at its
+offset. Faster peers come back for work sooner and so serve more of the
+file. Once the queue is empty, idle workers also fetch pieces still in
+flight on another peer, and whichever copy arrives first is kept, so one
+slow peer cannot hold up the end of the download. A peer that fails or
+serves bad pieces too often is dropped.
+"""
+import time
+import hashlib
+import logging
+from threading import Thread, Lock, Condition
+import requests
+
+PIECE_SIZE = 4 * 1024 * 1024
+MIN_PIECE_SIZE = 256 * 1024
+MAX_PIECE_SIZE = 64 * 1024 * 1024
+CONNECTIONS_PER_PEER = 2
+MAX_PEER_FAILURES = 3
+TIMEOUT = 30
+LISTING_WAIT = 600  # seconds to keep asking a peer that is still hashing the file
+
+logger = logging.getLogger(__name__)
+
+class SwarmError(Exception):
+    """The download could not be completed from the peers available"""
+
+def piece_hashes(fileobj, piece_size):
+    """MD5 of every piece of a file"""
+    return [hashlib.md5(piece).hexdigest() for piece in iter(lambda: fileobj.read(piece_size), b"")]
+
+def fetch_listing(node, filename, piece_size=PIECE_SIZE, wait=LISTING_WAIT):
+    """A peer's piece listing of a file: name, hash, size, piece_size, pieces.
+
+    A peer answers 503 while it hashes a large file; it is asked again after
+    its Retry-After for up to `wait` seconds.
+    """
+    deadline = time.time() + wait
+    while True:
+        resp = requests.get(f"http://{node}/pieces", params={'filename': filename, 'piece_size': piece_size},
+                            timeout=TIMEOUT)
+        if resp.status_code != 503 or time.time() >= deadline:
+            break
+        try:
+            delay = float(resp.headers.get('Retry-After', 1))
+        except ValueError:
+            delay = 1
+        time.sleep(min(delay, max(deadline - time.time(), 0)))
+    resp.raise_for_status()
+    return resp.json()
+
+class SwarmDownload:
+    """Download of one file described by a piece listing from a set of peers"""
+    def __init__(self, listing, peers):
+        self.name = listing['name']
+        self.size = listing['size']
+        self.piece_size = listing['piece_size']
+        self.pieces = listing['pieces']
+        self.missing = list(range(len(self.pieces)))
+        self.requested = {}  # piece index -> peers fetching it
+        self.failed = {}  # piece index -> peers that failed to deliver it
+        self.done = set()
+        self.failures = {peer: 0 for peer in peers}
+        self.stats = {peer: {'pieces': 0, 'bytes': 0, 'seconds': 0.0} for peer in peers}
+        self.changed = Condition()
+        self.write_lock = Lock()
+
+    def _alive(self, peer):
+        return self.failures[peer] < MAX_PEER_FAILURES
+
+    def _next_piece(self, peer):
+        """Piece for a peer's worker to fetch, or None when there is nothing left for it"""
+        with self.changed:
+            while self._alive(peer) and len(self.done) < len(self.pieces):
+                for index in self.missing:
+                    if peer not in self.failed.get(index, ()):
+                        self.missing.remove(index)
+                        self.requested.setdefault(index, set()).add(peer)
+                        return index
+                # Endgame: help with a piece another peer is still fetching
+                for index, peers in self.requested.items():
+                    if peer not in peers and len(peers) < 2 and peer not in self.failed.get(index, ()):
+                        peers.add(peer)
+                        return index
+                # Nothing for this peer right now; stop if nobody can make progress
+                if not self.requested and not any(self._alive(other) and other not in self.failed.get(index, ())
+                                                  for index in self.missing for other in self.failures):
+                    return None
+                self.changed.wait(1)
+            return None
+
+    def _fetch(self, session, peer, index):
+        start = index * self.piece_size
+        end = min(start + self.piece_size, self.size) - 1
+        with session.get(f"http://{peer}/download", params={'filename': self.name, 'replica': '1'},
+                         headers={'Range': f"bytes={start}-{end}"}, stream=True, timeout=TIMEOUT) as resp:
+            if resp.status_code != 206:
+                # Not worth retrying: the peer cannot serve ranges of this file
+                with self.changed:
+                    self.failures[peer] = MAX_PEER_FAILURES
+                raise SwarmError(f"{peer} answered {resp.status_code} to a range request")
+            data = resp.content
+        if len(data) != end - start + 1 or hashlib.md5(data).hexdigest() != self.pieces[index]:
+            raise SwarmError(f"{peer} sent a bad copy of piece {index}")
+        return data
+
+    def _worker(self, peer, fileobj):
+        session = requests.Session()
+        while True:
+            index = self._next_piece(peer)
+            if index is None:
+                return
+            started = time.time()
+            try:
+                data = self._fetch(session, peer, index)
+            except (requests.RequestException, SwarmError) as e:
+                logger.warning(f"Swarm download of '{self.name}': {e}")
+                with self.changed:
+                    self.failures[peer] += 1
+                    self.failed.setdefault(index, set()).add(peer)
+                    peers = self.requested.get(index, set())
+                    peers.discard(peer)
+                    if not peers and index not in self.done:
+                        self.requested.pop(index, None)
+                        self.missing.insert(0, index)
+                    self.changed.notify_all()
+                continue
+
+            with self.changed:
+                if index in self.done:
+                    continue  # another peer's copy arrived first
+                self.done.add(index)
+                self.requested.pop(index, None)
+                stats = self.stats[peer]
+                stats['pieces'] += 1
+                stats['bytes'] += len(data)
+                stats['seconds'] += time.time() - started
+                self.changed.notify_all()
+            with self.write_lock:
+                fileobj.seek(index * self.piece_size)
+                fileobj.write(data)
+
+    def run(self, fileobj):
+        """Write the whole file into fileobj; returns per-peer statistics"""
+        workers = [Thread(target=self._worker, args=(peer, fileobj), daemon=True)
+                   for peer in self.failures for _ in range(CONNECTIONS_PER_PEER)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if len(self.done) < len(self.pieces):
+            raise SwarmError(f"{len(self.pieces) - len(self.done)} pieces of '{self.name}' "
+                             f"could not be fetched from any peer")
+        fileobj.truncate(self.size)
+        return self.stats
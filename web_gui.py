@@ -1,20 +1,29 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_file, Response, stream_with_context
 from flask_cors import CORS
 import os
 import json
 import hashlib
-from datetime import datetime
+import threading
+import time
+import uuid
+import collections
 import requests
+from urllib.parse import quote
 from werkzeug.utils import secure_filename
+from storage_layout import normalize_path, prepare_location
+from storage_engine import StorageEngine, remote_listing
 
 app = Flask(__name__)
 CORS(app)
 
 STORAGE_DIR = 'storage'
 CONFIG_FILE = 'config.json'
-METADATA_FILE = 'metadata.json'
+UPLOAD_DIR = '.uploads'                 # partial chunked uploads
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_SESSION_TTL = 7 * 24 * 60 * 60   # abandoned uploads are removed after a week
 
 os.makedirs(STORAGE_DIR, exist_ok=True)
+os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 # Load configuration
 def load_config():
@@ -27,18 +36,14 @@ def save_config(config):
     with open(CONFIG_FILE, 'w') as f:
         json.dump(config, f, indent=2)
 
-def load_metadata():
-    if os.path.exists(METADATA_FILE):
-        with open(METADATA_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+# The index shared with the node and gui_v2
+storage = StorageEngine(STORAGE_DIR, load_config().get('tiering', {}).get('cold_dir', 'cold'))
 
-def calculate_hash(filepath):
-    hash_md5 = hashlib.md5()
-    with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+def register_file(filename, location, file_hash=None, size=None):
+    """Index a file stored at its sharded location; returns its entry"""
+    entry = storage.register(filename, location, file_hash, size)
+    dashboard.files_changed()
+    return entry
 
 @app.route('/')
 def index():
@@ -47,23 +52,13 @@ def index():
 @app.route('/api/files')
 def get_files():
     """Get list of all files"""
-    files_info = []
-    metadata = load_metadata()
-    
-    for filename in os.listdir(STORAGE_DIR):
-        filepath = os.path.join(STORAGE_DIR, filename)
-        if os.path.isfile(filepath):
-            stat = os.stat(filepath)
-            file_meta = metadata.get(filename, {})
-            
-            files_info.append({
-                'name': filename,
-                'size': stat.st_size,
-                'modified': datetime.fromtimestamp(stat.st_mtime).isoformat(),
-                'hash': file_meta.get('hash', calculate_hash(filepath)[:8])
-            })
-    
-    return jsonify(files_info)
+    files_info = storage.files()
+    
+    # Tag the listing with a hash of its content so unchanged polls get a 304
+    response = jsonify(files_info)
+    response.set_etag(hashlib.md5(response.get_data()).hexdigest())
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
@@ -76,112 +71,747 @@ def upload_file():
         return jsonify({'error': 'No file selected'}), 400
     
     filename = secure_filename(file.filename)
-    filepath = os.path.join(STORAGE_DIR, filename)
-    file.save(filepath)
+    location, filepath = prepare_location(STORAGE_DIR, filename)
+    # Replace the live file rather than rewrite it: its inode may be shared
+    # with a stored version
+    tmp_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.part")
+    try:
+        file.save(tmp_path)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
     
     # Update metadata
-    file_hash = calculate_hash(filepath)
-    metadata = load_metadata()
-    metadata[filename] = {
-        'hash': file_hash,
-        'size': os.path.getsize(filepath),
-        'uploaded': datetime.now().isoformat()
-    }
-    
-    with open(METADATA_FILE, 'w') as f:
-        json.dump(metadata, f, indent=2)
+    entry = register_file(filename, location)
     
     return jsonify({
         'message': 'File uploaded successfully',
         'filename': filename,
+        'hash': entry['hash']
+    })
+
+# Chunked, resumable uploads
+upload_sessions = {}
+upload_sessions_lock = threading.Lock()
+
+class UploadSession:
+    """A chunked upload reassembled in UPLOAD_DIR and hashed as chunks arrive"""
+    def __init__(self, upload_id, filename, size, chunk_size, received=(), created=None):
+        self.id = upload_id
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+        self.received = set(received)
+        self.created = created or time.time()
+        self.lock = threading.Lock()
+        # Chunks are hashed in order; the prefix before hashed_offset is in hasher
+        self.hasher = hashlib.md5()
+        self.hashed_offset = 0
+
+    @property
+    def part_path(self):
+        return os.path.join(UPLOAD_DIR, f"{self.id}.part")
+
+    @property
+    def state_path(self):
+        return os.path.join(UPLOAD_DIR, f"{self.id}.json")
+
+    @property
+    def chunk_count(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def save_state(self):
+        state = {
+            'filename': self.filename,
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'received': sorted(self.received),
+            'created': self.created
+        }
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def status(self):
+        with self.lock:
+            return {
+                'upload_id': self.id,
+                'filename': self.filename,
+                'size': self.size,
+                'chunk_size': self.chunk_size,
+                'chunks': self.chunk_count,
+                'received': sorted(self.received)
+            }
+
+    def advance_hash(self, fd):
+        """Hash received chunks that directly follow the hashed prefix (lock held)"""
+        while self.hashed_offset < self.size:
+            index = self.hashed_offset // self.chunk_size
+            if index not in self.received:
+                break
+            # Recently written chunks are still in the page cache
+            self.hasher.update(os.pread(fd, self.chunk_length(index), self.hashed_offset))
+            self.hashed_offset += self.chunk_length(index)
+
+    def write_chunk(self, index, stream):
+        """Stream one chunk to its offset in the part file"""
+        expected = self.chunk_length(index)
+        offset = index * self.chunk_size
+
+        with self.lock:
+            if index in self.received:
+                return
+            # Only the chunk right after the hashed prefix can be hashed while
+            # streaming; hash into a copy so a failed transfer leaves no trace
+            hasher = self.hasher.copy() if offset == self.hashed_offset else None
+
+        fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            written = 0
+            while written < expected:
+                data = stream.read(min(1024 * 1024, expected - written))
+                if not data:
+                    break
+                os.pwrite(fd, data, offset + written)
+                if hasher:
+                    hasher.update(data)
+                written += len(data)
+            if written != expected:
+                raise ValueError(f"Chunk {index} incomplete: got {written} of {expected} bytes")
+
+            with self.lock:
+                self.received.add(index)
+                if hasher and self.hashed_offset == offset:
+                    self.hasher = hasher
+                    self.hashed_offset = offset + expected
+                self.advance_hash(fd)
+                self.save_state()
+        finally:
+            os.close(fd)
+
+    def finish(self):
+        """Verify every chunk arrived and return the final file hash"""
+        with self.lock:
+            missing = [i for i in range(self.chunk_count) if i not in self.received]
+            if missing:
+                raise ValueError(f"Missing chunks: {missing[:10]}")
+            fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                self.advance_hash(fd)
+            finally:
+                os.close(fd)
+            return self.hasher.hexdigest()
+
+    def discard(self):
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+def load_upload_session(upload_id):
+    """Get an upload session from memory or from its saved state"""
+    with upload_sessions_lock:
+        session = upload_sessions.get(upload_id)
+        if session:
+            return session
+        state_path = os.path.join(UPLOAD_DIR, f"{upload_id}.json")
+        if not os.path.exists(state_path):
+            return None
+        with open(state_path) as f:
+            state = json.load(f)
+        session = UploadSession(upload_id, state['filename'], state['size'],
+                                state['chunk_size'], state['received'], state['created'])
+        upload_sessions[upload_id] = session
+        return session
+
+def prune_upload_sessions():
+    """Remove partial uploads abandoned for longer than UPLOAD_SESSION_TTL"""
+    cutoff = time.time() - UPLOAD_SESSION_TTL
+    for name in os.listdir(UPLOAD_DIR):
+        path = os.path.join(UPLOAD_DIR, name)
+        if os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            with upload_sessions_lock:
+                upload_sessions.pop(name.split('.')[0], None)
+
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    """Start or resume a chunked upload"""
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get('filename', ''))
+    size = data.get('size')
+
+    if not filename or not isinstance(size, int) or size < 0:
+        return jsonify({'error': 'filename and size are required'}), 400
+
+    prune_upload_sessions()
+
+    # The same file (name, size, mtime) always maps to the same upload,
+    # so re-selecting it after a reload resumes where it stopped
+    fingerprint = f"{filename}:{size}:{data.get('last_modified', '')}"
+    upload_id = hashlib.md5(fingerprint.encode()).hexdigest()[:16]
+
+    session = load_upload_session(upload_id)
+    if not session:
+        session = UploadSession(upload_id, filename, size, UPLOAD_CHUNK_SIZE)
+        with open(session.part_path, 'wb') as f:
+            f.truncate(size)
+        session.save_state()
+        with upload_sessions_lock:
+            upload_sessions[upload_id] = session
+
+    return jsonify(session.status())
+
+@app.route('/api/uploads')
+def list_uploads():
+    """List partial uploads that can be resumed"""
+    sessions = []
+    for name in os.listdir(UPLOAD_DIR):
+        if name.endswith('.json'):
+            session = load_upload_session(name[:-len('.json')])
+            if session:
+                sessions.append(session.status())
+    return jsonify({'uploads': sessions})
+
+@app.route('/api/uploads/<upload_id>')
+def get_upload(upload_id):
+    """Get which chunks of an upload have been received"""
+    session = load_upload_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(session.status())
+
+@app.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    """Receive one chunk of an upload"""
+    session = load_upload_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    if index < 0 or index >= session.chunk_count:
+        return jsonify({'error': 'Chunk index out of range'}), 400
+
+    try:
+        session.write_chunk(index, request.stream)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({'upload_id': upload_id, 'chunk': index})
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    """Move a fully received upload into storage"""
+    session = load_upload_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    try:
+        file_hash = session.finish()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+
+    location, filepath = prepare_location(STORAGE_DIR, session.filename)
+    os.replace(session.part_path, filepath)
+    session.discard()
+    with upload_sessions_lock:
+        upload_sessions.pop(upload_id, None)
+
+    register_file(session.filename, location, file_hash, session.size)
+
+    return jsonify({
+        'message': 'File uploaded successfully',
+        'filename': session.filename,
         'hash': file_hash
     })
 
-@app.route('/api/delete/<filename>', methods=['DELETE'])
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    """Abandon a partial upload"""
+    session = load_upload_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    session.discard()
+    with upload_sessions_lock:
+        upload_sessions.pop(upload_id, None)
+    return jsonify({'message': 'Upload aborted'})
+
+@app.route('/api/delete/<path:filename>', methods=['DELETE'])
 def delete_file(filename):
-    """Delete a file"""
-    filepath = os.path.join(STORAGE_DIR, secure_filename(filename))
+    """Delete a file, leaving a tombstone so that nodes delete it too"""
+    filename = normalize_path(filename)
     
-    if not os.path.exists(filepath):
+    if not filename or not storage.delete(filename):
         return jsonify({'error': 'File not found'}), 404
-    
-    os.remove(filepath)
-    
-    # Update metadata
-    metadata = load_metadata()
-    if filename in metadata:
-        del metadata[filename]
-        with open(METADATA_FILE, 'w') as f:
-            json.dump(metadata, f, indent=2)
+    dashboard.files_changed()
     
     return jsonify({'message': 'File deleted successfully'})
 
-@app.route('/api/download/<filename>')
+@app.route('/api/download/<path:filename>')
 def download_file(filename):
-    """Download a file"""
-    filepath = os.path.join(STORAGE_DIR, secure_filename(filename))
+    """Download a file (supports If-None-Match and Range requests)"""
+    filename = normalize_path(filename)
+    file_meta = storage.entry(filename) if filename else None
+    
+    if file_meta is None:
+        return jsonify({'error': 'File not found'}), 404
     
-    if not os.path.exists(filepath):
+    if file_meta.get('tier') == 'cold':
+        # Compressed on disk: stream the decompressed content
+        f = storage.open(filename)
+        response = Response(stream_with_context(iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b"")),
+                            mimetype='application/octet-stream',
+                            headers={'Content-Length': str(len(f))})
+        response.call_on_close(f.close)
+        response.headers.set('Content-Disposition', 'attachment', filename=os.path.basename(filename))
+        response.set_etag(file_meta['hash'])
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+    
+    filepath = storage.path(filename)
+    if not filepath:
         return jsonify({'error': 'File not found'}), 404
     
-    return send_file(filepath, as_attachment=True)
+    # Use the content hash as ETag when metadata still matches the file on disk,
+    # otherwise one derived from the file's current size and mtime
+    st = os.stat(filepath)
+    etag = f"{st.st_size:x}-{st.st_mtime_ns:x}"
+    if file_meta.get('hash') and (file_meta.get('size'), file_meta.get('mtime_ns')) == (st.st_size, st.st_mtime_ns):
+        etag = file_meta['hash']
+    
+    response = send_file(os.path.abspath(filepath), as_attachment=True,
+                         download_name=os.path.basename(filename), etag=etag, conditional=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# Background sync jobs
+SYNC_JOB_HISTORY = 20          # finished jobs kept for late subscribers
+SYNC_EVENT_INTERVAL = 0.5      # max SSE progress updates per second = 1 / interval
+SYNC_KEEPALIVE = 15            # seconds between SSE keep-alive comments
+
+sync_jobs = {}
+active_sync_targets = {}       # node -> job id currently syncing it
+sync_jobs_lock = threading.Lock()
+
+class SyncCancelled(Exception):
+    """Raised inside a transfer when its job is cancelled"""
+
+class ProgressReader:
+    """File wrapper that streams a file to requests and reports bytes read"""
+    def __init__(self, f, size, on_progress, cancel_event):
+        self.f = f
+        self.size = size
+        self.on_progress = on_progress
+        self.cancel_event = cancel_event
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        if self.cancel_event.is_set():
+            raise SyncCancelled()
+        chunk = self.f.read(size)
+        if chunk:
+            self.on_progress(len(chunk))
+        return chunk
+
+class SyncJob:
+    """A sync of local storage to one or more nodes, run in background threads"""
+    def __init__(self, nodes):
+        self.id = uuid.uuid4().hex[:12]
+        self.created = time.time()
+        self.finished = None
+        self.state = 'running'
+        self.cancel_event = threading.Event()
+        self.cond = threading.Condition()
+        self.version = 0
+        self.nodes = {node: {
+            'status': 'queued',
+            'files_total': 0,
+            'files_done': 0,
+            'bytes_total': 0,
+            'bytes_done': 0,
+            'rate': 0.0,
+            'eta': None,
+            'current': None,
+            'files': [],
+            'error': None,
+            'started': None
+        } for node in nodes}
+
+    def update(self, node, **fields):
+        with self.cond:
+            progress = self.nodes[node]
+            progress.update(fields)
+            if progress['started']:
+                elapsed = max(time.time() - progress['started'], 1e-6)
+                progress['rate'] = progress['bytes_done'] / elapsed
+                remaining = progress['bytes_total'] - progress['bytes_done']
+                progress['eta'] = remaining / progress['rate'] if progress['rate'] > 0 else None
+            self.version += 1
+            self.cond.notify_all()
+        dashboard.job_changed(self)
+
+    def add_bytes(self, node, count):
+        with self.cond:
+            bytes_done = self.nodes[node]['bytes_done'] + count
+        self.update(node, bytes_done=bytes_done)
+
+    def node_finished(self):
+        """Mark the job finished once every node thread is done"""
+        with self.cond:
+            if any(p['status'] in ('queued', 'running') for p in self.nodes.values()):
+                return
+            if self.cancel_event.is_set():
+                self.state = 'cancelled'
+            elif any(p['status'] == 'error' for p in self.nodes.values()):
+                self.state = 'error'
+            else:
+                self.state = 'done'
+            self.finished = time.time()
+            self.version += 1
+            self.cond.notify_all()
+        dashboard.job_changed(self)
+        with sync_jobs_lock:
+            for node in self.nodes:
+                if active_sync_targets.get(node) == self.id:
+                    del active_sync_targets[node]
+
+    def snapshot(self):
+        with self.cond:
+            return {
+                'job_id': self.id,
+                'state': self.state,
+                'created': self.created,
+                'finished': self.finished,
+                'nodes': {node: dict(p) for node, p in self.nodes.items()}
+            }
+
+def prune_sync_jobs():
+    """Forget the oldest finished jobs beyond SYNC_JOB_HISTORY"""
+    finished = sorted((job for job in sync_jobs.values() if job.finished),
+                      key=lambda job: job.finished)
+    for job in finished[:-SYNC_JOB_HISTORY]:
+        del sync_jobs[job.id]
+
+def sync_node(job, node):
+    """Push files missing on one node, streaming each file from disk"""
+    job.update(node, status='running')
+    try:
+        try:
+            remote_files = remote_listing(node)
+        except requests.HTTPError:
+            job.update(node, status='unreachable')
+            return
+
+        # Files the peer deleted are not sent back unless ours is newer
+        missing = sorted((f['name'], f['size'], f['clock']) for f in storage.missing_on(remote_files))
+
+        job.update(node,
+                   files_total=len(missing),
+                   bytes_total=sum(size for _, size, _ in missing),
+                   started=time.time())
+
+        sent = []
+        for filename, size, clock in missing:
+            if job.cancel_event.is_set():
+                raise SyncCancelled()
+            job.update(node, current=filename)
+            f = storage.open(filename)
+            if f is None:
+                continue  # deleted meanwhile
+            with f:
+                body = ProgressReader(f, size,
+                                      lambda count: job.add_bytes(node, count),
+                                      job.cancel_event)
+                resp = requests.post(
+                    f"http://{node}/upload",
+                    data=body,
+                    headers={'Filename': quote(filename), 'X-Clock': str(clock)},
+                    timeout=30
+                )
+            if resp.status_code == 200:
+                sent.append(filename)
+            job.update(node, files_done=job.nodes[node]['files_done'] + 1, files=list(sent))
+
+        job.update(node, status='success', current=None)
+    except SyncCancelled:
+        job.update(node, status='cancelled', current=None)
+    except Exception as e:
+        if job.cancel_event.is_set():
+            job.update(node, status='cancelled', current=None)
+        else:
+            job.update(node, status='error', error=str(e), current=None)
+    finally:
+        job.node_finished()
 
 @app.route('/api/sync', methods=['POST'])
 def sync_files():
-    """Sync files with all nodes"""
+    """Start a background sync job and return its ID"""
     config = load_config()
     nodes = config.get('nodes', [])
-    
+
+    data = request.get_json(silent=True) or {}
+    if data.get('nodes'):
+        nodes = [node for node in nodes if node in data['nodes']]
+
     if not nodes:
         return jsonify({'error': 'No nodes configured'}), 400
-    
-    local_files = set(os.listdir(STORAGE_DIR))
-    results = []
-    
-    for node in nodes:
-        try:
-            # Get their file list
-            r = requests.get(f"http://{node}/files", timeout=5)
-            if r.status_code != 200:
-                results.append({'node': node, 'status': 'unreachable'})
+
+    with sync_jobs_lock:
+        busy = {node: active_sync_targets[node] for node in nodes if node in active_sync_targets}
+        targets = [node for node in nodes if node not in busy]
+        if not targets:
+            return jsonify({'error': 'Sync already running for every target', 'busy': busy}), 409
+
+        job = SyncJob(targets)
+        sync_jobs[job.id] = job
+        for node in targets:
+            active_sync_targets[node] = job.id
+        prune_sync_jobs()
+
+    for node in targets:
+        threading.Thread(target=sync_node, args=(job, node), daemon=True).start()
+
+    return jsonify({'job_id': job.id, 'nodes': targets, 'busy': busy}), 202
+
+@app.route('/api/sync')
+def list_sync_jobs():
+    """List known sync jobs, newest first"""
+    with sync_jobs_lock:
+        jobs = sorted(sync_jobs.values(), key=lambda job: job.created, reverse=True)
+    return jsonify({'jobs': [job.snapshot() for job in jobs]})
+
+@app.route('/api/sync/<job_id>')
+def get_sync_job(job_id):
+    """Get the current progress of a sync job"""
+    job = sync_jobs.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.snapshot())
+
+@app.route('/api/sync/<job_id>/cancel', methods=['POST'])
+def cancel_sync_job(job_id):
+    """Cancel a running sync job"""
+    job = sync_jobs.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    job.cancel_event.set()
+    return jsonify({'message': 'Cancellation requested', 'job_id': job_id})
+
+@app.route('/api/sync/<job_id>/events')
+def sync_job_events(job_id):
+    """Stream sync job progress as Server-Sent Events"""
+    job = sync_jobs.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+
+    def generate():
+        seen = -1
+        while True:
+            with job.cond:
+                if job.version == seen:
+                    job.cond.wait(timeout=SYNC_KEEPALIVE)
+                version = job.version
+            if version == seen:
+                yield ": keep-alive\n\n"
                 continue
-            
-            remote_files_data = r.json()
-            remote_files = {f['name'] if isinstance(f, dict) else f 
-                          for f in remote_files_data}
-            
-            # Send missing files
-            missing = local_files - remote_files
-            sent = []
-            
-            for filename in missing:
-                filepath = os.path.join(STORAGE_DIR, filename)
-                with open(filepath, 'rb') as f:
-                    headers = {'Filename': filename}
-                    resp = requests.post(
-                        f"http://{node}/upload",
-                        data=f.read(),
-                        headers=headers,
-                        timeout=30
-                    )
-                    if resp.status_code == 200:
-                        sent.append(filename)
-            
-            results.append({
-                'node': node,
-                'status': 'success',
-                'files_sent': len(sent),
-                'files': sent
-            })
-            
-        except Exception as e:
-            results.append({
-                'node': node,
-                'status': 'error',
-                'error': str(e)
-            })
-    
-    return jsonify({'results': results})
+            seen = version
+            snapshot = job.snapshot()
+            event = 'done' if snapshot['finished'] else 'progress'
+            yield f"event: {event}\ndata: {json.dumps(snapshot)}\n\n"
+            if snapshot['finished']:
+                return
+            # Coalesce bursts of progress callbacks into one event per interval
+            time.sleep(SYNC_EVENT_INTERVAL)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Live dashboard: one background watcher per process turns changes to the
+# shared file index, node status and sync jobs into events; every open page streams
+# the same events, so extra tabs add no scanning or polling
+DASHBOARD_SCAN_INTERVAL = 2    # seconds between checks of the shared index for changes
+DASHBOARD_NODE_INTERVAL = 15   # seconds between node health checks
+DASHBOARD_HISTORY = 256        # events kept for pages that reconnect
+
+class Dashboard:
+    """Current dashboard state and a numbered history of changes to it"""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.events = collections.deque(maxlen=DASHBOARD_HISTORY)  # (id, event, JSON data)
+        self.last_id = 0
+        self.subscribers = 0
+        self.started = False
+        self.ready = False
+        self.files = {}
+        self.nodes = {}
+        self.stats = {}
+        self.dirty_jobs = {}
+        self.rescan = threading.Event()
+        self.recheck_nodes = threading.Event()
+
+    def subscribe(self):
+        with self.cond:
+            self.subscribers += 1
+            if not self.started:
+                self.started = True
+                threading.Thread(target=self._watch_files, daemon=True).start()
+                threading.Thread(target=self._watch_nodes, daemon=True).start()
+            self.cond.notify_all()
+
+    def unsubscribe(self):
+        with self.cond:
+            self.subscribers -= 1
+
+    def files_changed(self):
+        self.rescan.set()
+
+    def nodes_changed(self):
+        self.recheck_nodes.set()
+
+    def job_changed(self, job):
+        with self.cond:
+            self.dirty_jobs[job.id] = job
+        self.rescan.set()
+
+    def _publish(self, event, data):
+        # Called with self.cond held
+        # Serialized once here, not once per open page
+        self.last_id += 1
+        self.events.append((self.last_id, event, json.dumps(data)))
+        self.cond.notify_all()
+
+    def _update_stats(self):
+        # Called with self.cond held
+        stats = {
+            'total_files': len(self.files),
+            'total_size': sum(f['size'] for f in self.files.values()),
+            'nodes_total': len(self.nodes),
+            'nodes_online': sum(1 for online in self.nodes.values() if online)
+        }
+        if stats != self.stats:
+            self.stats = stats
+            self._publish('stats', stats)
+
+    def _wait_for_subscribers(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.subscribers > 0)
+
+    def _watch_files(self):
+        last_scan = 0
+        scanned_version = None
+        while True:
+            self._wait_for_subscribers()
+            self.rescan.wait(max(0, last_scan + DASHBOARD_SCAN_INTERVAL - time.time()))
+            self.rescan.clear()
+            with self.cond:
+                jobs, self.dirty_jobs = list(self.dirty_jobs.values()), {}
+            for job in jobs:
+                snapshot = job.snapshot()
+                with self.cond:
+                    self._publish('sync', snapshot)
+
+            files = None
+            if time.time() - last_scan >= DASHBOARD_SCAN_INTERVAL or not jobs:
+                last_scan = time.time()
+                try:
+                    # Only list the files again once the shared index has changed
+                    storage.refresh()
+                    if storage.index.version != scanned_version:
+                        scanned_version = storage.index.version
+                        files = {f['name']: f for f in storage.files()}
+                except (OSError, ValueError):
+                    scanned_version = None  # try again next scan
+            if files is not None:
+                with self.cond:
+                    changed = [f for name, f in files.items() if self.files.get(name) != f]
+                    removed = [name for name in self.files if name not in files]
+                    self.files = files
+                    if changed or removed:
+                        self._publish('files', {'changed': changed, 'removed': removed})
+                    self._update_stats()
+                    self.ready = True
+                    self.cond.notify_all()
+            if jobs:
+                # Coalesce bursts of progress updates into one event per interval
+                time.sleep(SYNC_EVENT_INTERVAL)
+
+    def _watch_nodes(self):
+        while True:
+            self._wait_for_subscribers()
+            nodes = {}
+            for node in load_config().get('nodes', []):
+                try:
+                    nodes[node] = requests.get(f"http://{node}/health", timeout=2).status_code == 200
+                except requests.RequestException:
+                    nodes[node] = False
+            with self.cond:
+                if nodes != self.nodes:
+                    self.nodes = nodes
+                    self._publish('nodes', nodes)
+                    self._update_stats()
+            self.recheck_nodes.wait(DASHBOARD_NODE_INTERVAL)
+            self.recheck_nodes.clear()
+
+    def snapshot(self):
+        """(last event id, full state) once the first scan is done"""
+        with sync_jobs_lock:
+            jobs = [job for job in sync_jobs.values() if not job.finished]
+        sync = [job.snapshot() for job in jobs]
+        with self.cond:
+            self.cond.wait_for(lambda: self.ready, timeout=SYNC_KEEPALIVE)
+            return self.last_id, {
+                'files': list(self.files.values()),
+                'nodes': self.nodes,
+                'stats': self.stats,
+                'sync': sync
+            }
+
+    def events_after(self, last_id, timeout):
+        """Events newer than last_id, waiting up to timeout; None if some were already dropped"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.last_id > last_id, timeout=timeout)
+            if self.events and self.events[0][0] > last_id + 1 or last_id > self.last_id:
+                return None
+            return [event for event in self.events if event[0] > last_id]
+
+dashboard = Dashboard()
+
+@app.route('/api/events')
+def dashboard_events():
+    """Stream file index, node status and sync changes as Server-Sent Events"""
+    try:
+        last_id = int(request.headers.get('Last-Event-ID', ''))
+    except ValueError:
+        last_id = None
+
+    def generate():
+        dashboard.subscribe()
+        try:
+            cursor = last_id
+            events = dashboard.events_after(cursor, 0) if cursor is not None else None
+            while True:
+                if events is None:
+                    # New page, or one that missed events: send the whole state
+                    snapshot_id, state = dashboard.snapshot()
+                    events = [(snapshot_id, 'snapshot', json.dumps(state))]
+                if not events:
+                    yield ": keep-alive\n\n"
+                for event_id, event, data in events:
+                    yield f"id: {event_id}\nevent: {event}\ndata: {data}\n\n"
+                    cursor = event_id
+                events = dashboard.events_after(cursor, SYNC_KEEPALIVE)
+        finally:
+            dashboard.unsubscribe()
+
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/nodes')
 def get_nodes():
@@ -198,15 +828,15 @@ def update_nodes():
     config = load_config()
     config['nodes'] = nodes
     save_config(config)
+    dashboard.nodes_changed()
     
     return jsonify({'message': 'Nodes updated', 'nodes': nodes})
 
 @app.route('/api/stats')
 def get_stats():
     """Get system statistics"""
-    files = os.listdir(STORAGE_DIR)
-    total_size = sum(os.path.getsize(os.path.join(STORAGE_DIR, f)) 
-                    for f in files if os.path.isfile(os.path.join(STORAGE_DIR, f)))
+    files = storage.files()
+    total_size = sum(f['size'] for f in files)
     
     config = load_config()
     